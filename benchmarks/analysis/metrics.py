@@ -0,0 +1,306 @@
+"""
+Figures of the RMSD, TFD and ddE metrics of the industry benchmark set.
+
+The metrics are read once into a frame with a categorical force field column,
+kept as a Parquet file next to the CSV, and every distribution of the figures of
+analysis-sage-2.1.0.ipynb (histograms of the rolling averages, Gaussian fits of
+the log-transformed metrics, KDEs, CDFs and log-normal fits) is computed for all
+force fields in one pass over the groups of the frame. The distributions of each
+force field are cached under a hash of its rows, so adding a force field to the
+comparison only computes the distributions of the new force field, and every
+figure is drawn from the cache.
+
+    python metrics.py -m ../03-metrics.csv -c metrics-cache -o .
+"""
+import hashlib
+import os
+import pickle
+import sys
+
+import click
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+from scipy.stats import gaussian_kde, lognorm
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "industry_benchmark_set"
+    ),
+)
+from metrics_store import read_store
+
+# drawn dashed
+REFERENCE_FORCE_FIELD = "GAFF 2.11 + AM1BCC"
+TITLE = "comparison on Industry benchmark set (70K+ conf.)"
+ROLLING_WINDOW = 10
+KDE_GRID_SIZE = 1000
+CDF_POINTS = 2001
+# bumped whenever the distributions computed here change, to invalidate the cache
+SUMMARY_VERSION = 1
+
+# axis labels, ranges and x limits of the figures of each metric; the CDF and
+# log-normal figures of absolute metrics are of their absolute values
+METRICS = {
+    "RMSD": {
+        "label": "RMSD (angstrom)",
+        "log_label": "Log(RMSD)",
+        "rolling_bins": (0, 4, 100),
+        "log_xlim": (-4, 2),
+        "kde_xlim": (-0.02, 3),
+        "absolute": False,
+        "cdf_xlim": (-0.02, 3),
+        "lognormal_xlim": (-0.02, 3),
+        "file_name": "rmsd",
+    },
+    "TFD": {
+        "label": "TFD",
+        "log_label": "Log(TFD)",
+        "rolling_bins": (0, 0.4, 100),
+        "log_xlim": (-6, 0),
+        "kde_xlim": (-0.02, 0.3),
+        "absolute": False,
+        "cdf_xlim": (-0.02, 0.3),
+        "lognormal_xlim": (-0.02, 0.3),
+        "file_name": "tfd",
+    },
+    "ddE": {
+        "label": "ddE (kcal/mol)",
+        "log_label": "Log(|ddE|)",
+        "rolling_bins": (-12, 12, 60),
+        "log_xlim": (-3, 5),
+        "kde_xlim": (-10, 10),
+        "absolute": True,
+        "cdf_xlim": (-0.02, 10),
+        "lognormal_xlim": (-0.02, 0.5),
+        "file_name": "absolute_ddE",
+    },
+}
+
+
+def load_metrics(csv_file):
+    """
+    The metrics CSV, or metrics store directory, as a frame with a categorical
+    force field column, read from the Parquet copy next to the CSV when it is
+    newer than the CSV.
+    """
+    if os.path.isdir(csv_file):
+        frame = read_store(csv_file)
+        frame["Force Field"] = frame["Force Field"].astype("category")
+        return frame
+    parquet_file = os.path.splitext(csv_file)[0] + ".parquet"
+    if (
+        os.path.exists(parquet_file)
+        and os.stat(parquet_file).st_mtime >= os.stat(csv_file).st_mtime
+    ):
+        return pd.read_parquet(parquet_file)
+    frame = pd.read_csv(csv_file)
+    frame["Force Field"] = frame["Force Field"].astype("category")
+    for column in METRICS:
+        frame[column] = frame[column].astype(np.float64)
+    try:
+        frame.to_parquet(parquet_file)
+    except ImportError:
+        # no Parquet engine installed, the CSV is read every time
+        pass
+    return frame
+
+
+def gauss_function(x, a, x0, sigma):
+    return a * np.exp(-((x - x0) ** 2) / (2 * sigma**2))
+
+
+def finite_nonzero(values):
+    return values[np.isfinite(values) & (values != 0)]
+
+
+def summarize_metric(values, settings):
+    """Every distribution drawn for one metric of one force field."""
+    summary = {}
+
+    ini, final, n_edges = settings["rolling_bins"]
+    rolling = pd.Series(values).rolling(window=ROLLING_WINDOW).mean().to_numpy()
+    counts, edges = np.histogram(rolling, np.linspace(ini, final, n_edges))
+    summary["rolling"] = (0.5 * (edges[1:] + edges[:-1]), counts)
+
+    logs = np.log(np.abs(finite_nonzero(values)))
+    counts, edges = np.histogram(logs, bins=200)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    parameters, _ = curve_fit(
+        gauss_function,
+        centers,
+        counts,
+        [1, np.mean(logs), np.std(logs)],
+        maxfev=100000,
+    )
+    x = np.linspace(edges[0], edges[-1], 1000)
+    summary["log_fit"] = (x, gauss_function(x, *parameters), parameters)
+
+    finite = values[np.isfinite(values)]
+    kde = gaussian_kde(finite)
+    bandwidth = np.sqrt(kde.covariance[0, 0])
+    # the grid of seaborn kdeplot, cut at 3 bandwidths
+    x = np.linspace(
+        finite.min() - 3 * bandwidth, finite.max() + 3 * bandwidth, KDE_GRID_SIZE
+    )
+    summary["kde"] = (x, kde(x))
+
+    cdf_values = np.abs(finite) if settings["absolute"] else finite
+    probabilities = np.linspace(0, 1, CDF_POINTS)
+    summary["cdf"] = (np.quantile(cdf_values, probabilities), probabilities)
+
+    positive = np.abs(finite_nonzero(values))
+    s, loc, scale = lognorm.fit(positive, floc=0)
+    x = np.linspace(positive.min(), positive.max(), 10000)
+    summary["lognormal"] = (
+        x,
+        lognorm.pdf(x, s, loc=loc, scale=scale),
+        (np.log(scale), s),
+    )
+    return summary
+
+
+def rows_hash(group):
+    digest = hashlib.sha256(str(SUMMARY_VERSION).encode())
+    digest.update(pd.util.hash_pandas_object(group[list(METRICS)], index=False).values)
+    return digest.hexdigest()
+
+
+def summarize(frame, cache_directory):
+    """
+    The distributions of every force field, by force field and metric, computed
+    in one pass over the force field groups and read from the cache for the
+    force fields whose rows have not changed.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    summaries = {}
+    for force_field, group in frame.groupby("Force Field", observed=True, sort=False):
+        cache_file = os.path.join(cache_directory, rows_hash(group) + ".pkl")
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as file:
+                summaries[force_field] = pickle.load(file)
+            continue
+        print(f"Computing the distributions of {force_field}")
+        summaries[force_field] = {
+            column: summarize_metric(group[column].to_numpy(), settings)
+            for column, settings in METRICS.items()
+        }
+        with open(cache_file, "wb") as file:
+            pickle.dump(summaries[force_field], file)
+    return summaries
+
+
+def plot(summaries, key, output_file, xlabel, ylabel, title, xlim=None, linewidth=3):
+    plt.figure(figsize=(15, 10))
+    plt.rcParams.update({"font.size": 16})
+    for force_field, curve in summaries.items():
+        x, y = curve[key][:2]
+        linestyle = "-." if force_field == REFERENCE_FORCE_FIELD else "-"
+        plt.plot(x, y, linestyle, linewidth=linewidth, label=force_field)
+    if xlim is not None:
+        plt.xlim(xlim)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.legend()
+    plt.title(title)
+    plt.savefig(output_file, dpi=300)
+    plt.close()
+
+
+def plot_all(summaries, output_directory):
+    """Draw the figures of the notebook from the distributions."""
+    for column, settings in METRICS.items():
+        curves = {
+            force_field: summary[column] for force_field, summary in summaries.items()
+        }
+        label = settings["label"]
+        absolute_label = f"|{column}|" + label[len(column) :]
+        cdf_label = absolute_label if settings["absolute"] else label
+        cdf_name = f"|{column}|" if settings["absolute"] else column
+
+        plot(
+            curves,
+            "rolling",
+            os.path.join(
+                output_directory, f"Rolling_average_of_{ROLLING_WINDOW}_{column}.png"
+            ),
+            f"{label}, rolling average with {ROLLING_WINDOW} points",
+            "Count",
+            f"{column} {TITLE}",
+        )
+        plot(
+            curves,
+            "log_fit",
+            os.path.join(
+                output_directory, f"Log_transform_of_{settings['file_name']}.png"
+            ),
+            r"$\mathregular{" + settings["log_label"] + "}$",
+            "Frequency",
+            f"{settings['log_label']} {TITLE}",
+            settings["log_xlim"],
+            linewidth=2,
+        )
+        plot(
+            curves,
+            "kde",
+            os.path.join(output_directory, f"KDE_plot_of_{column}.png"),
+            f"{label}, KDE plot",
+            "KDE",
+            f"{column} {TITLE}",
+            settings["kde_xlim"],
+        )
+        plot(
+            curves,
+            "cdf",
+            os.path.join(output_directory, f"CDF_plot_of_{column}.png"),
+            f"{cdf_label}, CDF plot",
+            "CDF",
+            f"{cdf_name} {TITLE}",
+            settings["cdf_xlim"],
+        )
+        plot(
+            curves,
+            "lognormal",
+            os.path.join(output_directory, f"lognormal_plot_of_{column}.png"),
+            f"{cdf_label}, Log-normal plot",
+            "PDF",
+            f"{cdf_name} {TITLE}",
+            settings["lognormal_xlim"],
+        )
+        for force_field, curve in curves.items():
+            mu, sigma = curve["lognormal"][2]
+            print(f"{column} {force_field}, mean: {mu:.4f}, sigma: {sigma:.4f}")
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--metrics",
+    "metrics_file",
+    type=click.STRING,
+    default="../03-metrics.csv",
+)
+@click.option(
+    "-c",
+    "--cache_dir",
+    "cache_directory",
+    type=click.STRING,
+    default="metrics-cache",
+)
+@click.option(
+    "-o",
+    "--output_dir",
+    "output_directory",
+    type=click.STRING,
+    default=".",
+)
+def main(metrics_file, cache_directory, output_directory):
+    frame = load_metrics(metrics_file)
+    summaries = summarize(frame, cache_directory)
+    plot_all(summaries, output_directory)
+
+
+if __name__ == "__main__":
+    main()
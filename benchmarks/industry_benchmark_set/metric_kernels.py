@@ -0,0 +1,144 @@
+"""
+NumPy kernels of the RMSD, TFD and ddE metrics over the conformers of a molecule.
+
+The QM and MM geometries of all the conformers of a molecule are stacked into
+(n_conformers, n_atoms, 3) arrays and the metrics of every conformer are taken
+in one call: the heavy atom RMSD after the optimal superposition (a batched
+Kabsch alignment), the torsion fingerprint deviation of RDKit
+(TorsionFingerprints.GetTFDBetweenMolecules with its default settings) from the
+torsion quartets, maximal deviations and weights RDKit lists for the molecule,
+which only depend on the molecule and are computed once, and the ddE relative
+to the QM minimum conformer.
+"""
+import numpy as np
+
+
+def batched_rmsd(reference, positions):
+    """
+    RMSD of every pair of (n_conformers, n_atoms, 3) geometries after the
+    optimal superposition.
+    """
+    reference = reference - reference.mean(axis=1, keepdims=True)
+    positions = positions - positions.mean(axis=1, keepdims=True)
+    u, s, vt = np.linalg.svd(np.einsum("cai,caj->cij", positions, reference))
+    # no reflections
+    s[:, -1] *= np.sign(np.linalg.det(u @ vt))
+    squared = (reference**2).sum(axis=(1, 2)) + (positions**2).sum(axis=(1, 2))
+    squared -= 2 * s.sum(axis=1)
+    return np.sqrt(np.maximum(squared, 0.0) / reference.shape[1])
+
+
+def torsion_terms(rdkit_molecule):
+    """
+    The torsions of the TFD of a molecule as arrays: the atom quartets, the
+    torsion of each quartet, whether each torsion is a ring torsion, and the
+    maximal deviation and weight of each torsion.
+    """
+    from rdkit.Chem import TorsionFingerprints
+
+    torsions, ring_torsions = TorsionFingerprints.CalculateTorsionLists(rdkit_molecule)
+    quartets, torsion_of_quartet, ring, max_deviations = [], [], [], []
+    for is_ring, torsion_list in [(False, torsions), (True, ring_torsions)]:
+        for torsion_quartets, max_deviation in torsion_list:
+            for quartet in torsion_quartets:
+                quartets.append(quartet)
+                torsion_of_quartet.append(len(ring))
+            ring.append(is_ring)
+            max_deviations.append(max_deviation)
+    weights = (
+        TorsionFingerprints.CalculateTorsionWeights(rdkit_molecule)
+        if len(ring) > 0
+        else []
+    )
+    return {
+        "quartets": np.array(quartets, dtype=np.int64).reshape(-1, 4),
+        "torsion": np.array(torsion_of_quartet, dtype=np.int64),
+        "ring": np.array(ring, dtype=bool),
+        "max_deviation": np.array(max_deviations, dtype=np.float64),
+        "weights": np.array(weights, dtype=np.float64),
+    }
+
+
+def dihedrals(positions, quartets):
+    """Dihedral angles in degrees, (n_conformers, n_quartets), in (-180, 180]."""
+    p0, p1, p2, p3 = (positions[:, quartets[:, i]] for i in range(4))
+    b0 = p0 - p1
+    b1 = p2 - p1
+    b2 = p3 - p2
+    b1 = b1 / np.linalg.norm(b1, axis=-1, keepdims=True)
+    v = b0 - (b0 * b1).sum(axis=-1, keepdims=True) * b1
+    w = b2 - (b2 * b1).sum(axis=-1, keepdims=True) * b1
+    x = (v * w).sum(axis=-1)
+    y = (np.cross(b1, v) * w).sum(axis=-1)
+    return np.degrees(np.arctan2(y, x))
+
+
+def torsion_deviations(reference, positions, terms):
+    """
+    Deviation in degrees of every torsion, (n_conformers, n_torsions): the
+    smallest circular difference between the quartets of a torsion, or between
+    the mean absolute dihedrals of the quartets of a ring torsion.
+    """
+    n_torsions = len(terms["ring"])
+    torsion = terms["torsion"]
+    ring_quartet = terms["ring"][torsion]
+
+    angles = []
+    for geometry in [reference, positions]:
+        dihedral = dihedrals(geometry, terms["quartets"])
+        # the mean absolute dihedral of each ring torsion
+        ring_sums = np.zeros((len(geometry), n_torsions))
+        np.add.at(
+            ring_sums.T, torsion[ring_quartet], np.abs(dihedral[:, ring_quartet]).T
+        )
+        counts = np.bincount(torsion[ring_quartet], minlength=n_torsions)
+        ring_means = ring_sums / np.maximum(counts, 1)
+        angles.append((np.mod(dihedral, 360.0), ring_means))
+
+    deviations = np.full((len(reference), n_torsions), 180.0)
+    # every pair of quartets of the same chain torsion
+    chain = np.flatnonzero(~ring_quartet)
+    first, second = np.meshgrid(chain, chain, indexing="ij")
+    same = torsion[first] == torsion[second]
+    first, second = first[same], second[same]
+    difference = np.abs(angles[0][0][:, first] - angles[1][0][:, second])
+    difference = np.minimum(difference, 360.0 - difference)
+    np.minimum.at(deviations.T, torsion[first], difference.T)
+
+    rings = terms["ring"]
+    difference = np.abs(angles[0][1][:, rings] - angles[1][1][:, rings])
+    deviations[:, rings] = np.minimum(
+        deviations[:, rings], np.minimum(difference, 360.0 - difference)
+    )
+    return deviations
+
+
+def batched_tfd(reference, positions, terms):
+    """Weighted TFD of every pair of geometries, nan without torsions."""
+    if len(terms["ring"]) == 0:
+        return np.full(len(reference), np.nan)
+    deviations = torsion_deviations(reference, positions, terms)
+    deviations /= terms["max_deviation"]
+    return deviations @ terms["weights"] / terms["weights"].sum()
+
+
+def relative_energy_differences(qm_energies, mm_energies):
+    """ddE of every conformer relative to the QM minimum conformer."""
+    reference = np.argmin(qm_energies)
+    return (mm_energies - mm_energies[reference]) - (
+        qm_energies - qm_energies[reference]
+    )
+
+
+def molecule_metrics(
+    qm_positions, mm_positions, qm_energies, mm_energies, heavy, terms
+):
+    """
+    RMSD of the heavy atoms, TFD and ddE of every conformer of a molecule from
+    its stacked (n_conformers, n_atoms, 3) QM and MM geometries.
+    """
+    return {
+        "RMSD": batched_rmsd(qm_positions[:, heavy], mm_positions[:, heavy]),
+        "TFD": batched_tfd(qm_positions, mm_positions, terms),
+        "ddE": relative_energy_differences(qm_energies, mm_energies),
+    }
@@ -0,0 +1,278 @@
+"""
+Append-only store of the metrics of the industry benchmark set.
+
+The metrics of every force field live in a partition of their own, a directory
+of Parquet files keyed by QCArchive record and conformer, listed with the
+summary of the partition in manifest.json. Adding the metrics of a new force
+field only writes its partition and its summary; the partitions of the other
+force fields are never read or rewritten, and the comparison figures are drawn
+from the summaries.
+
+    python metrics_store.py append -s metrics-store -m new-metrics.csv
+    python metrics_store.py plot -s metrics-store -o full
+    python metrics_store.py export -s metrics-store -o 03-metrics.csv
+"""
+import hashlib
+import json
+import os
+import re
+
+import click
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+METRICS_COLUMNS = [
+    "Force Field",
+    "SMILES",
+    "Conformer Idx",
+    "Record ID",
+    "RMSD",
+    "TFD",
+    "ddE",
+]
+KEY_COLUMNS = ["Record ID", "Conformer Idx"]
+MANIFEST_FILE = "manifest.json"
+CDF_POINTS = 1001
+# kcal/mol
+DDE_RANGE_EDGES = [-np.inf, -2.0, -1.0, -0.5, 0.5, 1.0, 2.0, np.inf]
+
+
+def read_manifest(store):
+    manifest_file = os.path.join(store, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file:
+        return json.load(file)
+
+
+def write_json(file_name, payload):
+    # replaced only once written completely
+    with open(file_name + ".tmp", "w") as file:
+        json.dump(payload, file, indent=2)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def partition_name(force_field):
+    slug = re.sub(r"[^A-Za-z0-9.+-]+", "_", force_field).strip("_")
+    return f"{slug}-{hashlib.sha256(force_field.encode()).hexdigest()[:8]}"
+
+
+def read_partition(store, entry, columns=None):
+    return pd.concat(
+        [
+            pd.read_parquet(
+                os.path.join(store, entry["directory"], part), columns=columns
+            )
+            for part in entry["parts"]
+        ],
+        ignore_index=True,
+    )
+
+
+def read_store(store):
+    """All the rows of the store, also read by ../analysis/metrics.py."""
+    manifest = read_manifest(store)
+    if len(manifest) == 0:
+        return pd.DataFrame(columns=METRICS_COLUMNS)
+    return pd.concat(
+        [read_partition(store, entry) for entry in manifest.values()],
+        ignore_index=True,
+    )
+
+
+def summarize_partition(frame):
+    """The distributions the comparison figures are drawn from."""
+    probabilities = np.linspace(0, 1, CDF_POINTS)
+    summary = {"rows": len(frame)}
+    for column, values in [
+        ("RMSD", frame["RMSD"]),
+        ("TFD", frame["TFD"]),
+        ("ddE", frame["ddE"].abs()),
+    ]:
+        values = values.to_numpy(dtype=np.float64)
+        values = values[np.isfinite(values)]
+        summary[column] = {
+            "mean": float(np.mean(values)) if len(values) > 0 else None,
+            "median": float(np.median(values)) if len(values) > 0 else None,
+            "quantiles": np.quantile(values, probabilities).tolist()
+            if len(values) > 0
+            else [],
+        }
+    counts, _ = np.histogram(frame["ddE"].dropna(), DDE_RANGE_EDGES)
+    summary["ddE_ranges"] = counts.tolist()
+    return summary
+
+
+def append_metrics(store, frame):
+    """
+    Add the rows of every force field of the frame to its partition, skipping
+    the rows whose record and conformer are already stored, and refresh the
+    summaries of the partitions that changed.
+    """
+    os.makedirs(store, exist_ok=True)
+    manifest = read_manifest(store)
+    for force_field, rows in frame.groupby("Force Field", sort=False):
+        entry = manifest.get(force_field)
+        if entry is None:
+            entry = {"directory": partition_name(force_field), "parts": []}
+        directory = os.path.join(store, entry["directory"])
+        os.makedirs(directory, exist_ok=True)
+
+        rows = rows.drop_duplicates(KEY_COLUMNS)
+        if len(entry["parts"]) > 0:
+            stored = read_partition(store, entry, KEY_COLUMNS)
+            stored_keys = pd.MultiIndex.from_frame(stored)
+            new = ~pd.MultiIndex.from_frame(rows[KEY_COLUMNS]).isin(stored_keys)
+            print(f"{force_field}: {len(rows) - new.sum()} rows already stored")
+            rows = rows[new]
+        if len(rows) == 0:
+            continue
+
+        part = f"part-{len(entry['parts']):05d}.parquet"
+        rows.to_parquet(os.path.join(directory, part + ".tmp"), index=False)
+        os.replace(
+            os.path.join(directory, part + ".tmp"), os.path.join(directory, part)
+        )
+        entry["parts"].append(part)
+        entry["summary"] = summarize_partition(read_partition(store, entry))
+        manifest[force_field] = entry
+        # a part is only part of the store once it is in the manifest
+        write_json(os.path.join(store, MANIFEST_FILE), manifest)
+        print(f"{force_field}: {len(rows)} rows appended")
+    return manifest
+
+
+def step_plot(manifest, column, xlabel, output_file, xlim):
+    plt.figure(figsize=(10, 7))
+    for force_field, entry in manifest.items():
+        quantiles = entry["summary"][column]["quantiles"]
+        if len(quantiles) > 0:
+            plt.step(
+                quantiles,
+                np.linspace(0, 1, len(quantiles)),
+                where="post",
+                label=force_field,
+            )
+    plt.xlim(xlim)
+    plt.xlabel(xlabel)
+    plt.ylabel("Fraction of conformers")
+    plt.legend()
+    plt.savefig(output_file, dpi=300)
+    plt.close()
+
+
+def dde_ranges_plot(manifest, output_file):
+    edges = DDE_RANGE_EDGES
+    # np.histogram bins are closed on the left
+    labels = [f"[{edges[i]:g}, {edges[i + 1]:g})" for i in range(len(edges) - 1)]
+    width = 0.8 / max(len(manifest), 1)
+    plt.figure(figsize=(12, 7))
+    for index, (force_field, entry) in enumerate(manifest.items()):
+        counts = np.array(entry["summary"]["ddE_ranges"], dtype=np.float64)
+        plt.bar(
+            np.arange(len(counts)) + index * width,
+            counts / max(counts.sum(), 1),
+            width,
+            label=force_field,
+        )
+    plt.xticks(np.arange(len(labels)) + 0.4 - width / 2, labels)
+    plt.xlabel("ddE (kcal/mol)")
+    plt.ylabel("Fraction of conformers")
+    plt.legend()
+    plt.savefig(output_file, dpi=300)
+    plt.close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("append")
+@click.option(
+    "-s",
+    "--store",
+    "store",
+    type=click.STRING,
+    default="metrics-store",
+)
+@click.option(
+    "-m",
+    "--metrics",
+    "metrics_file",
+    type=click.STRING,
+    required=True,
+)
+def append(store, metrics_file):
+    append_metrics(store, pd.read_csv(metrics_file))
+
+
+@cli.command("plot")
+@click.option(
+    "-s",
+    "--store",
+    "store",
+    type=click.STRING,
+    default="metrics-store",
+)
+@click.option(
+    "-o",
+    "--output_dir",
+    "output_directory",
+    type=click.STRING,
+    default="full",
+)
+@click.option(
+    "-ff",
+    "--force_field",
+    "force_fields",
+    type=click.STRING,
+    multiple=True,
+)
+def plot(store, output_directory, force_fields):
+    manifest = read_manifest(store)
+    if len(force_fields) > 0:
+        manifest = {ff: manifest[ff] for ff in force_fields}
+    os.makedirs(output_directory, exist_ok=True)
+    step_plot(
+        manifest,
+        "RMSD",
+        "RMSD (angstrom)",
+        os.path.join(output_directory, "step-rmsd.png"),
+        (0, 3),
+    )
+    step_plot(
+        manifest, "TFD", "TFD", os.path.join(output_directory, "step-tfd.png"), (0, 0.5)
+    )
+    step_plot(
+        manifest,
+        "ddE",
+        "|ddE| (kcal/mol)",
+        os.path.join(output_directory, "step-dde.png"),
+        (0, 10),
+    )
+    dde_ranges_plot(manifest, os.path.join(output_directory, "dde-in-ranges.png"))
+
+
+@cli.command("export")
+@click.option(
+    "-s",
+    "--store",
+    "store",
+    type=click.STRING,
+    default="metrics-store",
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    type=click.STRING,
+    default="03-metrics.csv",
+)
+def export(store, output_file):
+    read_store(store).to_csv(output_file, index=False)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,512 @@
+"""
+MM re-optimization of the QM conformers of the industry benchmark set.
+
+The conformers of a local copy of the benchmark set (sdf files of QCArchive
+optimization records, with the SMILES QCArchive, Record QCArchive and Energy
+QCArchive tags) are grouped by molecule and split into shards. Any number of
+worker processes, on any number of nodes sharing the work directory, claim the
+shards through lock files, minimize every conformer of a molecule in one
+context and write the RMSD, TFD and ddE of the shard in the format of
+03-metrics.csv. A finished shard is never run again, so an interrupted run picks
+up where it stopped, and the shards of a worker that died are claimed again once
+its lock has not been touched for --reclaim_after seconds.
+
+    python reoptimize.py plan -i industry-benchmark-set -w reoptimization
+    python reoptimize.py run -w reoptimization -ff openff-2.1.0.offxml -np 64
+    python reoptimize.py collect -w reoptimization -ff openff-2.1.0.offxml -s metrics-store
+"""
+import functools
+import json
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from metric_kernels import molecule_metrics, torsion_terms
+from metrics_store import METRICS_COLUMNS, append_metrics
+
+offlogger = logging.getLogger("openff")
+offlogger.setLevel(logging.ERROR)
+offlogger.propagate = False
+
+
+def read_sdf_tags(sdf_file):
+    """The SMILES QCArchive tag of every record of an sdf file, read as text."""
+    smiles = []
+    with open(sdf_file) as file:
+        lines = iter(file)
+        for line in lines:
+            if line.startswith("> <SMILES QCArchive>"):
+                smiles.append(next(lines).strip())
+    return smiles
+
+
+def force_field_label(ff_name):
+    return os.path.splitext(os.path.basename(ff_name))[0]
+
+
+def shard_names(work_directory):
+    return sorted(path.stem for path in Path(work_directory, "shards").glob("*.json"))
+
+
+def result_file(work_directory, label, shard):
+    return Path(work_directory, "results", label, shard + ".csv")
+
+
+def failures_file(work_directory, label, shard):
+    return Path(work_directory, "results", label, shard + ".failures.json")
+
+
+def take_over_lock(lock, reclaim_after):
+    """
+    Remove a lock that has not been touched for reclaim_after seconds. The lock
+    is first renamed to a name of this worker, which only one worker can do,
+    and put back if another worker claimed the shard again in the meantime.
+    """
+    taken = lock.with_name(f"{lock.name}.{socket.gethostname()}-{os.getpid()}")
+    try:
+        os.rename(lock, taken)
+    except FileNotFoundError:
+        return
+    if time.time() - taken.stat().st_mtime > reclaim_after:
+        taken.unlink()
+        return
+    # a fresh lock of another worker
+    try:
+        os.link(taken, lock)
+    except FileExistsError:
+        pass
+    taken.unlink()
+
+
+def claim_shard(work_directory, label, reclaim_after):
+    """Claim the first unfinished shard that no live worker holds."""
+    claims = Path(work_directory, "claims", label)
+    claims.mkdir(parents=True, exist_ok=True)
+    for shard in shard_names(work_directory):
+        if result_file(work_directory, label, shard).exists():
+            continue
+        lock = claims / (shard + ".lock")
+        try:
+            if time.time() - lock.stat().st_mtime > reclaim_after:
+                # the worker holding it stopped touching it
+                take_over_lock(lock, reclaim_after)
+        except FileNotFoundError:
+            pass
+        try:
+            descriptor = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(descriptor, "w") as file:
+            file.write(f"{socket.gethostname()} {os.getpid()}\n")
+        return shard, lock
+    return None, None
+
+
+@functools.lru_cache(maxsize=4)
+def read_sdf_records(sdf_file):
+    """
+    Every record of an sdf file, parsed once for all the conformers and
+    molecules of the file that a worker runs one after another.
+    """
+    from openff.toolkit.topology import Molecule
+
+    records = Molecule.from_file(
+        sdf_file, file_format="sdf", allow_undefined_stereo=True
+    )
+    return records if isinstance(records, list) else [records]
+
+
+def read_molecule_conformers(records):
+    """
+    The molecule of the first record with the geometries (angstrom) of all
+    the records as conformers in its atom order, and the record ids and QM
+    energies (kcal/mol) of the conformers.
+    """
+    from openff.toolkit.topology import Molecule
+
+    # every file is parsed once, whatever the order of its records
+    by_file = defaultdict(list)
+    for position, (sdf_file, index) in enumerate(records):
+        by_file[sdf_file].append((position, index))
+    parsed = [None] * len(records)
+    for sdf_file, positions in by_file.items():
+        file_records = read_sdf_records(sdf_file)
+        for position, index in positions:
+            parsed[position] = file_records[index]
+
+    molecule = None
+    record_ids, qm_energies = [], []
+    for record in parsed:
+        if molecule is None:
+            molecule = Molecule(record)
+        else:
+            _, atom_map = Molecule.are_isomorphic(
+                record, molecule, return_atom_map=True
+            )
+            molecule.add_conformer(record.remap(atom_map).conformers[0])
+        record_ids.append(int(record.properties["Record QCArchive"]))
+        qm_energies.append(float(record.properties["Energy QCArchive"]))
+    return molecule, record_ids, np.array(qm_energies)
+
+
+def minimize_conformers(force_field, records, tolerance):
+    """
+    The molecule of the records, their record ids, the stacked QM and MM
+    geometries (angstrom) of its conformers and their QM and MM energies
+    (kcal/mol).
+    """
+    import openmm
+
+    molecule, record_ids, qm_energies = read_molecule_conformers(records)
+    system = force_field.create_openmm_system(molecule.to_topology())
+    integrator = openmm.VerletIntegrator(0.001)
+    platform = openmm.Platform.getPlatformByName("CPU")
+    # one context for all the conformers of the molecule
+    context = openmm.Context(system, integrator, platform, {"Threads": "1"})
+
+    qm_positions = np.array([c.m_as("angstrom") for c in molecule.conformers])
+    mm_positions = np.zeros_like(qm_positions)
+    mm_energies = np.zeros(len(qm_positions))
+    for index, positions in enumerate(qm_positions):
+        context.setPositions(positions / 10)
+        openmm.LocalEnergyMinimizer.minimize(
+            context, tolerance * openmm.unit.kilojoule_per_mole / openmm.unit.nanometer
+        )
+        state = context.getState(getEnergy=True, getPositions=True)
+        mm_positions[index] = state.getPositions(asNumpy=True).value_in_unit(
+            openmm.unit.angstrom
+        )
+        mm_energies[index] = state.getPotentialEnergy().value_in_unit(
+            openmm.unit.kilocalorie_per_mole
+        )
+    return molecule, record_ids, qm_positions, mm_positions, qm_energies, mm_energies
+
+
+def conformer_metrics(molecule, qm_positions, mm_positions, qm_energies, mm_energies):
+    heavy = np.array([atom.atomic_number != 1 for atom in molecule.atoms])
+    return molecule_metrics(
+        qm_positions,
+        mm_positions,
+        qm_energies,
+        mm_energies,
+        heavy,
+        torsion_terms(molecule.to_rdkit()),
+    )
+
+
+def rdkit_metrics(molecule, qm_positions, mm_positions):
+    """The RMSD and TFD of every conformer one at a time through RDKit."""
+    from rdkit.Chem import TorsionFingerprints, rdMolAlign
+
+    qm_molecule = molecule.to_rdkit()
+    mm_molecule = molecule.to_rdkit()
+    heavy = [
+        atom.GetIdx() for atom in qm_molecule.GetAtoms() if atom.GetAtomicNum() != 1
+    ]
+    rmsd, tfd = [], []
+    for qm, mm in zip(qm_positions, mm_positions):
+        for rdkit_molecule, positions in [(qm_molecule, qm), (mm_molecule, mm)]:
+            conformer = rdkit_molecule.GetConformer()
+            for atom, position in enumerate(positions):
+                conformer.SetAtomPosition(atom, position.tolist())
+        try:
+            tfd.append(
+                TorsionFingerprints.GetTFDBetweenMolecules(qm_molecule, mm_molecule)
+            )
+        except (IndexError, ValueError):
+            # no rotatable torsions
+            tfd.append(np.nan)
+        rmsd.append(
+            rdMolAlign.AlignMol(
+                mm_molecule, qm_molecule, atomMap=[(i, i) for i in heavy]
+            )
+        )
+    return {"RMSD": np.array(rmsd), "TFD": np.array(tfd)}
+
+
+def reoptimize_molecule(force_field, label, smiles, records, tolerance):
+    """The metrics rows of the conformers of a molecule."""
+    molecule, record_ids, *geometries_and_energies = minimize_conformers(
+        force_field, records, tolerance
+    )
+    metrics = conformer_metrics(molecule, *geometries_and_energies)
+    return [
+        {
+            "Force Field": label,
+            "SMILES": smiles,
+            "Conformer Idx": index,
+            "Record ID": record_ids[index],
+            "RMSD": metrics["RMSD"][index],
+            "TFD": metrics["TFD"][index],
+            "ddE": metrics["ddE"][index],
+        }
+        for index in range(len(record_ids))
+    ]
+
+
+def run_worker(job):
+    """Claim and run shards until none are left, returning how many were run."""
+    work_directory, ff_name, tolerance, reclaim_after = job
+    from openff.toolkit.typing.engines.smirnoff import ForceField
+
+    force_field = ForceField(ff_name, load_plugins=True)
+    label = force_field_label(ff_name)
+    finished = 0
+    while True:
+        shard, lock = claim_shard(work_directory, label, reclaim_after)
+        if shard is None:
+            return finished
+        with open(Path(work_directory, "shards", shard + ".json")) as file:
+            molecules = json.load(file)
+        rows = []
+        failures = {}
+        for smiles, records in molecules.items():
+            try:
+                rows += reoptimize_molecule(
+                    force_field, label, smiles, records, tolerance
+                )
+            except Exception as error:
+                failures[smiles] = f"{type(error).__name__}: {error}"
+                print(f"{shard}: {smiles} failed, {failures[smiles]}")
+            # the claim is alive as long as its lock is touched
+            lock.touch()
+        output = result_file(work_directory, label, shard)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        # the failed molecules are listed before the shard counts as finished
+        failures_output = failures_file(work_directory, label, shard)
+        with open(str(failures_output) + ".tmp", "w") as file:
+            json.dump(failures, file, indent=2)
+        os.replace(str(failures_output) + ".tmp", failures_output)
+        pd.DataFrame(rows, columns=METRICS_COLUMNS).to_csv(
+            str(output) + ".tmp", index=False
+        )
+        os.replace(str(output) + ".tmp", output)
+        lock.unlink(missing_ok=True)
+        finished += 1
+        print(f"{shard} finished on {socket.gethostname()}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("plan")
+@click.option(
+    "-i",
+    "--input_dir",
+    "input_directory",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "-w",
+    "--work_dir",
+    "work_directory",
+    type=click.STRING,
+    default="reoptimization",
+)
+@click.option(
+    "-ns",
+    "--shard_size",
+    "shard_size",
+    type=click.INT,
+    default=50,
+)
+def plan(input_directory, work_directory, shard_size):
+    """Group the conformers by molecule and split the molecules into shards."""
+    molecules = defaultdict(list)
+    for sdf_file in sorted(Path(input_directory).glob("**/*.sdf")):
+        for index, smiles in enumerate(read_sdf_tags(sdf_file)):
+            molecules[smiles].append((str(sdf_file.resolve()), index))
+    shards = Path(work_directory, "shards")
+    shards.mkdir(parents=True, exist_ok=True)
+    names = sorted(molecules)
+    for start in range(0, len(names), shard_size):
+        with open(shards / f"shard-{start // shard_size:06d}.json", "w") as file:
+            json.dump(
+                {
+                    smiles: molecules[smiles]
+                    for smiles in names[start : start + shard_size]
+                },
+                file,
+            )
+    print(
+        f"{len(names)} molecules with {sum(map(len, molecules.values()))} "
+        f"conformers in {len(shard_names(work_directory))} shards"
+    )
+
+
+@cli.command("run")
+@click.option(
+    "-w",
+    "--work_dir",
+    "work_directory",
+    type=click.STRING,
+    default="reoptimization",
+)
+@click.option(
+    "-ff",
+    "--ff",
+    "ff_name",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "-np",
+    "--n_processes",
+    "n_processes",
+    type=click.INT,
+    default=os.cpu_count(),
+)
+@click.option(
+    "-tol",
+    "--tolerance",
+    "tolerance",
+    type=click.FLOAT,
+    default=10.0,
+)
+@click.option(
+    "-ra",
+    "--reclaim_after",
+    "reclaim_after",
+    type=click.FLOAT,
+    default=3600.0,
+)
+def run(work_directory, ff_name, n_processes, tolerance, reclaim_after):
+    """Run the unfinished shards on a pool of worker processes."""
+    job = (work_directory, ff_name, tolerance, reclaim_after)
+    with Pool(n_processes) as pool:
+        finished = sum(pool.map(run_worker, [job] * n_processes))
+    print(f"{finished} shards finished")
+
+
+@cli.command("collect")
+@click.option(
+    "-w",
+    "--work_dir",
+    "work_directory",
+    type=click.STRING,
+    default="reoptimization",
+)
+@click.option(
+    "-ff",
+    "--ff",
+    "ff_name",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    type=click.STRING,
+    default=None,
+)
+@click.option(
+    "-s",
+    "--store",
+    "store",
+    type=click.STRING,
+    default=None,
+)
+def collect(work_directory, ff_name, output_file, store):
+    """Write the metrics of the finished shards to a CSV or a metrics store."""
+    label = force_field_label(ff_name)
+    shards = shard_names(work_directory)
+    finished = [
+        result_file(work_directory, label, shard)
+        for shard in shards
+        if result_file(work_directory, label, shard).exists()
+    ]
+    print(f"{len(finished)} of {len(shards)} shards finished")
+    if len(finished) == 0:
+        return
+    failed = 0
+    for shard in shards:
+        if failures_file(work_directory, label, shard).exists():
+            with open(failures_file(work_directory, label, shard)) as file:
+                failed += len(json.load(file))
+    if failed > 0:
+        print(
+            f"{failed} molecules failed, listed in the .failures.json files of "
+            "their shards"
+        )
+    frame = pd.concat([pd.read_csv(file) for file in finished], ignore_index=True)
+    if output_file is not None:
+        frame.to_csv(output_file, index=False)
+    if store is not None:
+        append_metrics(store, frame)
+
+
+@cli.command("validate")
+@click.option(
+    "-w",
+    "--work_dir",
+    "work_directory",
+    type=click.STRING,
+    default="reoptimization",
+)
+@click.option(
+    "-ff",
+    "--ff",
+    "ff_name",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "-n",
+    "--n_molecules",
+    "n_molecules",
+    type=click.INT,
+    default=100,
+)
+@click.option(
+    "-tol",
+    "--tolerance",
+    "tolerance",
+    type=click.FLOAT,
+    default=10.0,
+)
+def validate(work_directory, ff_name, n_molecules, tolerance):
+    """Compare the metric kernels with RDKit on the first molecules of the shards."""
+    from openff.toolkit.typing.engines.smirnoff import ForceField
+
+    force_field = ForceField(ff_name, load_plugins=True)
+    differences = {"RMSD": [], "TFD": []}
+    validated = 0
+    for shard in shard_names(work_directory):
+        if validated == n_molecules:
+            break
+        with open(Path(work_directory, "shards", shard + ".json")) as file:
+            molecules = json.load(file)
+        for smiles, records in molecules.items():
+            if validated == n_molecules:
+                break
+            molecule, _, *geometries_and_energies = minimize_conformers(
+                force_field, records, tolerance
+            )
+            kernels = conformer_metrics(molecule, *geometries_and_energies)
+            reference = rdkit_metrics(molecule, *geometries_and_energies[:2])
+            for metric in differences:
+                differences[metric].append(
+                    np.nanmax(np.abs(kernels[metric] - reference[metric]))
+                )
+            validated += 1
+    for metric, values in differences.items():
+        print(
+            f"{metric}: largest difference from RDKit {np.nanmax(values):.2e} "
+            f"over {validated} molecules"
+        )
+
+
+if __name__ == "__main__":
+    cli()
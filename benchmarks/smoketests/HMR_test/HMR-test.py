@@ -1,11 +1,151 @@
 # Create an openforcefield Molecule object from SMILES
-from openff.toolkit.topology import Molecule
+import json
 import logging
+import os
+import sys
+from multiprocessing import Pool
+
+import click
+from openff.toolkit.topology import Molecule
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from batched_systems import simulate_batch
+from system_cache import cached_system, force_field_hash
 
 offlogger = logging.getLogger("openff")
 offlogger.setLevel(logging.ERROR)
 offlogger.propagate = False
 
+# 1 ns at 4 fs
+N_ITERATIONS = 1000
+N_STEPS_PER_ITERATION = 250
+
+
+def read_results(file_name):
+    """
+    Outcome of every molecule already run, keyed by the hash of the force
+    field, index and SMILES.
+    """
+    results = {}
+    if os.path.exists(file_name):
+        with open(file_name) as file:
+            for line in file:
+                if line.strip():
+                    result = json.loads(line)
+                    # run again, alone or in another batch
+                    if result.get("inconclusive", False):
+                        continue
+                    # results of files without the hash are never reused
+                    results[
+                        (
+                            result.get("force_field_hash"),
+                            result["index"],
+                            result["smiles"],
+                        )
+                    ] = result
+    return results
+
+
+def run_hmr(job):
+    """Run a batch of molecules in one system and the result of each of them."""
+    ff_name, ff_hash, system_cache, batch, check_interval, max_temperature = job
+    results = {
+        ind: {
+            "force_field": ff_name,
+            "force_field_hash": ff_hash,
+            "index": ind,
+            "smiles": molecule.to_smiles(),
+            "passed": False,
+            "inconclusive": False,
+            "iteration": None,
+            "step": None,
+            "atoms": None,
+            "error": None,
+        }
+        for ind, molecule in batch
+    }
+    from simtk import openmm, unit
+    from simtk.openmm import app
+
+    forcefield_kwargs = {
+        "constraints": app.HBonds,
+        "rigidWater": True,
+        "removeCMMotion": False,
+        "hydrogenMass": 4 * unit.amu,
+    }
+    # Initialize a SystemGenerator using GAFF
+    from openmmforcefields.generators import SystemGenerator
+
+    system_generators = []
+
+    def create_system(molecule):
+        # the generator is only set up when a system is not in the cache
+        if len(system_generators) == 0:
+            system_generators.append(
+                SystemGenerator(
+                    small_molecule_forcefield=ff_name,
+                    forcefield_kwargs=forcefield_kwargs,
+                    molecules=[molecule for ind, molecule in batch],
+                )
+            )
+        # Create an OpenMM System from an Open Force Field toolkit Topology object
+        return system_generators[0].create_system(molecule.to_topology().to_openmm())
+
+    indices, systems, positions = [], [], []
+    for ind, molecule in batch:
+        try:
+            system = cached_system(
+                system_cache,
+                ff_hash,
+                molecule,
+                forcefield_kwargs,
+                lambda: create_system(molecule),
+            )
+            molecule.generate_conformers()
+        except Exception as error:
+            results[ind]["error"] = f"{type(error).__name__}: {error}"
+            continue
+        indices.append(ind)
+        systems.append(system)
+        positions.append(molecule.conformers[0].m_as("nanometer"))
+
+    # Run a simulation
+    temperature = 300 * unit.kelvin
+    collision_rate = 1.0 / unit.picoseconds
+    timestep = 4.0 * unit.femtoseconds
+
+    def make_integrator():
+        # Use BAOAB
+        return openmm.LangevinMiddleIntegrator(temperature, collision_rate, timestep)
+
+    # Integrate, checking every molecule every check_interval steps and
+    # dropping a molecule as soon as it blows up; one thread per batch, the
+    # batches are spread over the processes
+    failures, inconclusive = (
+        simulate_batch(
+            systems,
+            positions,
+            make_integrator,
+            N_ITERATIONS * N_STEPS_PER_ITERATION,
+            check_interval,
+            max_temperature,
+            {"Threads": "1"},
+        )
+        if len(systems) > 0
+        else ({}, set())
+    )
+    for member, ind in enumerate(indices):
+        result = results[ind]
+        if member in failures:
+            result["step"], result["error"], result["atoms"] = failures[member]
+            result["iteration"] = result["step"] // N_STEPS_PER_ITERATION
+        elif member in inconclusive:
+            result["inconclusive"] = True
+            result["error"] = "batch failure not reproduced after the split"
+        else:
+            result["passed"] = True
+    return list(results.values())
+
 
 @click.command()
 @click.option(
@@ -15,7 +155,57 @@ offlogger.propagate = False
     type=click.STRING,
     default="force-field-no-cosmetic-params.offxml",
 )
-def main(ff_name):
+@click.option(
+    "-np",
+    "--n_processes",
+    "n_processes",
+    type=click.INT,
+    default=os.cpu_count(),
+)
+@click.option(
+    "-bs",
+    "--batch_size",
+    "batch_size",
+    type=click.INT,
+    default=1,
+)
+@click.option(
+    "-ci",
+    "--check_interval",
+    "check_interval",
+    type=click.INT,
+    default=2500,
+)
+@click.option(
+    "-mt",
+    "--max_temperature",
+    "max_temperature",
+    type=click.FLOAT,
+    default=1000.0,
+)
+@click.option(
+    "-sc",
+    "--system_cache",
+    "system_cache",
+    type=click.STRING,
+    default="system-cache",
+)
+@click.option(
+    "-r",
+    "--results",
+    "results_file",
+    type=click.STRING,
+    default="hmr-results.jsonl",
+)
+def main(
+    ff_name,
+    n_processes,
+    batch_size,
+    check_interval,
+    max_temperature,
+    system_cache,
+    results_file,
+):
     hmr_mols = Molecule.from_file(
         "propynes.smi",
         file_format="smi",
@@ -30,54 +220,75 @@ def main(ff_name):
 
     # Define the keyword arguments to feed to ForceField; use heavy hydrogens and constrained X-H bonds
     # (Note that this differs a bit from allowing SMIRNOFF to control masses and cosntraints)
-    fails = 0
-    for ind, molecule in enumerate(hmr_mols):
+    # molecules with an outcome in the results file are not run again
+    # (an offxml edited in place is run again)
+    ff_hash = force_field_hash(ff_name)
+    results = read_results(results_file)
+    pending = [
+        (ind, molecule)
+        for ind, molecule in enumerate(hmr_mols)
+        if (ff_hash, ind, molecule.to_smiles()) not in results
+    ]
+    # batch_size molecules share one system and context
+    jobs = [
+        (
+            ff_name,
+            ff_hash,
+            # an empty --system_cache turns the cache off
+            system_cache or None,
+            pending[i : i + batch_size],
+            check_interval,
+            max_temperature,
+        )
+        for i in range(0, len(pending), batch_size)
+    ]
+    print(
+        f"Running HMR with force field {ff_name} on {len(pending)} molecules, "
+        f"{len(hmr_mols) - len(pending)} already in {results_file}"
+    )
+    with Pool(n_processes) as pool, open(results_file, "a") as file:
+        for batch_results in pool.imap_unordered(run_hmr, jobs):
+            for result in batch_results:
+                file.write(json.dumps(result) + "\n")
+                results[(ff_hash, result["index"], result["smiles"])] = result
+                if result["inconclusive"]:
+                    print(result["index"], result["smiles"], result["error"])
+                elif not result["passed"]:
+                    print(
+                        result["index"],
+                        result["smiles"],
+                        "Failed HMR test at step",
+                        result["step"],
+                        result["error"],
+                        "atoms",
+                        result["atoms"],
+                    )
+            file.flush()
+
+    fails = sorted(
+        (
+            result
+            for key, result in results.items()
+            if key[0] == ff_hash
+            and not result["passed"]
+            and not result.get("inconclusive", False)
+        ),
+        key=lambda result: result["index"],
+    )
+    for result in fails:
+        print(result["index"], result["smiles"], "step", result["step"])
+    print("Total failures = ", len(fails))
+    n_inconclusive = sum(
+        result.get("inconclusive", False)
+        for key, result in results.items()
+        if key[0] == ff_hash
+    )
+    if n_inconclusive > 0:
         print(
-            f"Running HMR with force field {ff_name} and molecule {ind} with SMILES {molecule.to_smiles()}"
+            "Inconclusive = ",
+            n_inconclusive,
+            "(run again, e.g. with --batch_size 1, to retry them)",
         )
-        try:
-            from simtk import openmm, unit
-            from simtk.openmm import app
-
-            forcefield_kwargs = {
-                "constraints": app.HBonds,
-                "rigidWater": True,
-                "removeCMMotion": False,
-                "hydrogenMass": 4 * unit.amu,
-            }
-            # Initialize a SystemGenerator using GAFF
-            from openmmforcefields.generators import SystemGenerator
-
-            system_generator = SystemGenerator(
-                small_molecule_forcefield=ff_name,
-                forcefield_kwargs=forcefield_kwargs,
-                molecules=molecule,
-            )
-            # Create an OpenMM System from an Open Force Field toolkit Topology object
-            system = system_generator.create_system(molecule.to_topology().to_openmm())
-            # Run a simulation
-            temperature = 300 * unit.kelvin
-            collision_rate = 1.0 / unit.picoseconds
-            timestep = 4.0 * unit.femtoseconds
-            # Use BAOAB
-            integrator = openmm.LangevinMiddleIntegrator(
-                temperature, collision_rate, timestep
-            )
-            context = openmm.Context(system, integrator)
-            molecule.generate_conformers()
-            context.setPositions(molecule.conformers[0])
-            # Integrate
-            niterations = 1000
-            nsteps_per_iteration = 250
-            for iteration in range(niterations):
-                integrator.step(nsteps_per_iteration)
-                state = context.getState(getEnergy=True)
-        #             print(f'{state.getTime()/unit.picoseconds:12.3f} ps :  potential {state.getPotentialEnergy()/unit.kilocalories_per_mole:16.3f} kcal/mol')
-        except Exception:
-            fails = +1
-            print(ind, molecule.to_smiles(), "Failed HMR test")
-
-    print("Total failures = ", fails)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""
+Batched OpenMM systems of small molecules for the smoke tests.
+
+A context of a molecule of 5-50 atoms spends most of its time in the setup of
+the context and the overhead of every step. Many molecules are instead packed
+into one System in vacuum, spaced apart on a grid, in which the nonbonded
+interactions of each molecule are written out as pairs between its own atoms
+(a CustomBondForce reproducing its NoCutoff NonbondedForce, exceptions included)
+so the molecules do not interact. Failures are attributed to the molecules by
+checking the atoms of each molecule, and a batch that fails as a whole is split
+in two and run again from its last sound state until the failing molecule is
+alone. The halves do not draw the same random numbers as the whole batch did,
+so a failure is not always reproduced; the molecules of a split batch that
+finish cleanly are reported as inconclusive rather than passed.
+"""
+import numpy as np
+import openmm
+from openmm import unit
+
+# kJ/mol nm / e^2
+ONE_4PI_EPS0 = 138.935456
+# kJ/mol/K
+MOLAR_GAS_CONSTANT = 0.00831446261815324
+
+
+def add_intramolecular_pairs(pairs, nonbonded, offset):
+    """The pairs of a NoCutoff NonbondedForce, as bonds of the pair force."""
+    if nonbonded.getNonbondedMethod() != openmm.NonbondedForce.NoCutoff:
+        raise ValueError("only NoCutoff nonbonded forces can be batched")
+    n_particles = nonbonded.getNumParticles()
+    charges = np.zeros(n_particles)
+    sigmas = np.zeros(n_particles)
+    epsilons = np.zeros(n_particles)
+    for i in range(n_particles):
+        charge, sigma, epsilon = nonbonded.getParticleParameters(i)
+        charges[i] = charge.value_in_unit(unit.elementary_charge)
+        sigmas[i] = sigma.value_in_unit(unit.nanometer)
+        epsilons[i] = epsilon.value_in_unit(unit.kilojoule_per_mole)
+
+    exceptions = {}
+    for index in range(nonbonded.getNumExceptions()):
+        i, j, charge_product, sigma, epsilon = nonbonded.getExceptionParameters(index)
+        exceptions[(min(i, j), max(i, j))] = (
+            charge_product.value_in_unit(unit.elementary_charge**2),
+            sigma.value_in_unit(unit.nanometer),
+            epsilon.value_in_unit(unit.kilojoule_per_mole),
+        )
+
+    for i in range(n_particles):
+        for j in range(i + 1, n_particles):
+            charge_product, sigma, epsilon = exceptions.get(
+                (i, j),
+                (
+                    charges[i] * charges[j],
+                    0.5 * (sigmas[i] + sigmas[j]),
+                    np.sqrt(epsilons[i] * epsilons[j]),
+                ),
+            )
+            if charge_product == 0 and epsilon == 0:
+                continue
+            pairs.addBond(i + offset, j + offset, [charge_product, sigma, epsilon])
+
+
+def merge_systems(systems):
+    """
+    One System of all the molecules of the systems and the index of the first
+    atom of each molecule in it. A single system is returned as it is.
+    """
+    if len(systems) == 1:
+        return systems[0], [0]
+
+    merged = openmm.System()
+    bonds = openmm.HarmonicBondForce()
+    angles = openmm.HarmonicAngleForce()
+    torsions = openmm.PeriodicTorsionForce()
+    pairs = openmm.CustomBondForce(
+        f"{ONE_4PI_EPS0}*charge_product/r + 4*epsilon*((sigma/r)^12 - (sigma/r)^6)"
+    )
+    for parameter in ["charge_product", "sigma", "epsilon"]:
+        pairs.addPerBondParameter(parameter)
+
+    offsets = []
+    for system in systems:
+        offset = merged.getNumParticles()
+        offsets.append(offset)
+        for i in range(system.getNumParticles()):
+            merged.addParticle(system.getParticleMass(i))
+        for index in range(system.getNumConstraints()):
+            i, j, distance = system.getConstraintParameters(index)
+            merged.addConstraint(i + offset, j + offset, distance)
+        for force in system.getForces():
+            if isinstance(force, openmm.HarmonicBondForce):
+                for index in range(force.getNumBonds()):
+                    i, j, length, k = force.getBondParameters(index)
+                    bonds.addBond(i + offset, j + offset, length, k)
+            elif isinstance(force, openmm.HarmonicAngleForce):
+                for index in range(force.getNumAngles()):
+                    i, j, k, angle, force_constant = force.getAngleParameters(index)
+                    angles.addAngle(
+                        i + offset, j + offset, k + offset, angle, force_constant
+                    )
+            elif isinstance(force, openmm.PeriodicTorsionForce):
+                for index in range(force.getNumTorsions()):
+                    (
+                        i,
+                        j,
+                        k,
+                        l,
+                        periodicity,
+                        phase,
+                        force_constant,
+                    ) = force.getTorsionParameters(index)
+                    torsions.addTorsion(
+                        i + offset,
+                        j + offset,
+                        k + offset,
+                        l + offset,
+                        periodicity,
+                        phase,
+                        force_constant,
+                    )
+            elif isinstance(force, openmm.NonbondedForce):
+                add_intramolecular_pairs(pairs, force, offset)
+            elif not isinstance(force, openmm.CMMotionRemover):
+                raise ValueError(f"{force.__class__.__name__} cannot be batched")
+
+    for force in [bonds, angles, torsions, pairs]:
+        merged.addForce(force)
+    return merged, offsets
+
+
+def batch_positions(positions, spacing=5.0):
+    """The positions (nm) of the molecules, centred on the points of a cubic grid."""
+    side = int(np.ceil(len(positions) ** (1 / 3)))
+    placed = []
+    for index, molecule_positions in enumerate(positions):
+        point = np.array(np.unravel_index(index, (side, side, side))) * spacing
+        placed.append(molecule_positions - molecule_positions.mean(axis=0) + point)
+    return np.concatenate(placed)
+
+
+def degrees_of_freedom(system):
+    masses = particle_masses(system)
+    return 3 * np.count_nonzero(masses) - system.getNumConstraints()
+
+
+def particle_masses(system):
+    return np.array(
+        [
+            system.getParticleMass(i).value_in_unit(unit.dalton)
+            for i in range(system.getNumParticles())
+        ]
+    )
+
+
+def check_molecule(positions, velocities, masses, n_dof, max_temperature, n_atoms=5):
+    """
+    None when the atoms of a molecule are sound, otherwise the reason the
+    molecule blew up and the offending atoms: those with non-finite
+    coordinates, or else those with the largest kinetic energies.
+    """
+    bad_atoms = np.flatnonzero(~np.isfinite(positions).all(axis=1))
+    if len(bad_atoms) > 0:
+        return "non-finite coordinates", bad_atoms.tolist()
+
+    # kJ/mol from Da nm^2/ps^2
+    kinetic_energies = 0.5 * masses * (velocities**2).sum(axis=1)
+    hot_atoms = np.argsort(-kinetic_energies)[:n_atoms].tolist()
+    temperature = 2 * kinetic_energies.sum() / (n_dof * MOLAR_GAS_CONSTANT)
+    if not np.isfinite(temperature) or temperature > max_temperature:
+        return f"temperature {temperature:.0f} K", hot_atoms
+    return None
+
+
+def simulate_batch(
+    systems,
+    positions,
+    make_integrator,
+    n_steps,
+    check_interval,
+    max_temperature,
+    platform_properties=None,
+):
+    """
+    Run the molecules of the systems, with their positions (nm), together for
+    n_steps, checking every molecule every check_interval steps. Returns the
+    failures by molecule index as (step, reason, offending atoms), with the
+    atoms numbered within their molecule, and the set of the molecules that
+    finished in a batch split after a failure it could not attribute.
+    """
+    platform = openmm.Platform.getPlatformByName("CPU")
+    masses = [particle_masses(system) for system in systems]
+    n_dofs = [degrees_of_freedom(system) for system in systems]
+    failures = {}
+    inconclusive = set()
+    # molecules, their positions and velocities, the step they start at and
+    # whether they were split off a batch that failed as a whole
+    batches = [(list(range(len(systems))), list(positions), None, 0, False)]
+    while len(batches) > 0:
+        members, member_positions, member_velocities, step, split = batches.pop()
+        system, offsets = merge_systems([systems[m] for m in members])
+        slices = [
+            slice(offset, offset + len(masses[m]))
+            for m, offset in zip(members, offsets)
+        ]
+        integrator = make_integrator()
+        context = openmm.Context(
+            system, integrator, platform, platform_properties or {}
+        )
+        context.setPositions(batch_positions(member_positions))
+        if member_velocities is not None:
+            context.setVelocities(np.concatenate(member_velocities))
+
+        while step < n_steps:
+            n = min(check_interval, n_steps - step)
+            try:
+                integrator.step(n)
+                state = context.getState(
+                    getEnergy=True, getPositions=True, getVelocities=True
+                )
+                potential = state.getPotentialEnergy().value_in_unit(
+                    unit.kilojoule_per_mole
+                )
+                error = (
+                    None if np.isfinite(potential) else "non-finite potential energy"
+                )
+            except openmm.OpenMMException as exception:
+                error = f"OpenMMException: {exception}"
+            if error is None:
+                all_positions = state.getPositions(asNumpy=True).value_in_unit(
+                    unit.nanometer
+                )
+                all_velocities = state.getVelocities(asNumpy=True).value_in_unit(
+                    unit.nanometer / unit.picosecond
+                )
+                instabilities = {
+                    m: check_molecule(
+                        all_positions[atoms],
+                        all_velocities[atoms],
+                        masses[m],
+                        n_dofs[m],
+                        max_temperature,
+                    )
+                    for m, atoms in zip(members, slices)
+                }
+                unstable = [m for m in members if instabilities[m] is not None]
+                if len(unstable) > 0:
+                    # go on without the unstable molecules
+                    for m in unstable:
+                        failures[m] = (step + n, *instabilities[m])
+                    kept = [i for i, m in enumerate(members) if m not in unstable]
+                    if len(kept) == 0:
+                        break
+                    batches.append(
+                        (
+                            [members[i] for i in kept],
+                            [np.array(all_positions[slices[i]]) for i in kept],
+                            [np.array(all_velocities[slices[i]]) for i in kept],
+                            step + n,
+                            split,
+                        )
+                    )
+                    break
+                step += n
+                # the last sound state, which a split batch starts again from
+                member_positions = [np.array(all_positions[atoms]) for atoms in slices]
+                member_velocities = [
+                    np.array(all_velocities[atoms]) for atoms in slices
+                ]
+            elif len(members) == 1:
+                failures[members[0]] = (step + n, error, None)
+                break
+            else:
+                # the failure is not attributable, run both halves again
+                half = len(members) // 2
+                for part in [slice(None, half), slice(half, None)]:
+                    batches.append(
+                        (
+                            members[part],
+                            member_positions[part],
+                            None
+                            if member_velocities is None
+                            else member_velocities[part],
+                            step,
+                            True,
+                        )
+                    )
+                break
+        if split and step >= n_steps:
+            # the failure of the whole batch may not have been reproduced
+            inconclusive.update(members)
+        del context, integrator
+    return failures, inconclusive
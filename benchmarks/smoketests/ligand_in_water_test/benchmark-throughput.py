@@ -0,0 +1,254 @@
+# Throughput of a ligand in water on the CPU platform, in ns/day, for each force field and time step
+import io
+import json
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import openmm
+import openmm.app
+from openff.interchange import Interchange
+from openff.toolkit import ForceField, Molecule, Topology
+from openff.units.openmm import from_openmm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from system_cache import cached_system, force_field_hash
+
+TEMPERATURE = 300 * openmm.unit.kelvin
+# name: (time step in fs, hydrogen mass of the ligand in amu or None to keep the masses)
+PROTOCOLS = {
+    "2fs": (2.0, None),
+    "4fs-hmr": (4.0, 3.0),
+}
+
+
+def repartition_hydrogen_mass(system, molecule, hydrogen_mass, offset=0):
+    """Move mass from the heavy atoms of a molecule to their hydrogens."""
+    hydrogen_mass = hydrogen_mass * openmm.unit.amu
+    for bond in molecule.bonds:
+        atoms = [bond.atom1, bond.atom2]
+        hydrogens = [atom for atom in atoms if atom.atomic_number == 1]
+        if len(hydrogens) != 1:
+            continue
+        hydrogen = offset + molecule.atom_index(hydrogens[0])
+        heavy = offset + molecule.atom_index(
+            atoms[1] if hydrogens[0] is atoms[0] else atoms[0]
+        )
+        transferred = hydrogen_mass - system.getParticleMass(hydrogen)
+        system.setParticleMass(hydrogen, hydrogen_mass)
+        system.setParticleMass(heavy, system.getParticleMass(heavy) - transferred)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_case(
+    ff_name, protocol, pdb, n_steps, n_warmup, report_interval, threads, cache
+):
+    time_step, hydrogen_mass = PROTOCOLS[protocol]
+    record = {
+        "force_field": ff_name,
+        "protocol": protocol,
+        "time_step_fs": time_step,
+        "hydrogen_mass_amu": hydrogen_mass,
+        "n_atoms": pdb.topology.getNumAtoms(),
+        "threads": threads,
+        "cached_system": cache is not None,
+    }
+    ligand = Molecule.from_file("32_conf1_initial.sdf", allow_undefined_stereo=True)
+    water = Molecule.from_mapped_smiles("[H:2][O:1][H:3]")
+    n_waters = (pdb.topology.getNumAtoms() - ligand.n_atoms) // 3
+    topology = Topology.from_molecules([ligand, *n_waters * [water]])
+    topology.box_vectors = from_openmm(pdb.topology.getPeriodicBoxVectors())
+
+    def create_system():
+        force_field = ForceField(ff_name, allow_cosmetic_attributes=True)
+        _, record["charging_s"] = timed(
+            ligand.assign_partial_charges, partial_charge_method="am1bcc"
+        )
+        interchange, record["parameterization_s"] = timed(
+            Interchange.from_smirnoff,
+            force_field=force_field,
+            topology=topology,
+            charge_from_molecules=[ligand],
+        )
+        system, record["system_build_s"] = timed(
+            interchange.to_openmm, combine_nonbonded_forces=True
+        )
+        return system
+
+    # with the cache the setup is only the time to read the system back
+    system, record["setup_s"] = timed(
+        cached_system,
+        cache,
+        force_field_hash(ff_name) if cache is not None else None,
+        ligand,
+        {"waters": n_waters, "box": pdb.topology.getPeriodicBoxVectors()},
+        create_system,
+    )
+    if hydrogen_mass is not None:
+        # the ligand comes first, the waters are rigid
+        repartition_hydrogen_mass(system, ligand, hydrogen_mass)
+    system.addForce(openmm.MonteCarloBarostat(1.00 * openmm.unit.bar, TEMPERATURE, 25))
+    integrator = openmm.LangevinMiddleIntegrator(
+        TEMPERATURE, 1 / openmm.unit.picosecond, time_step * openmm.unit.femtoseconds
+    )
+    platform = openmm.Platform.getPlatformByName("CPU")
+    properties = {} if threads is None else {"Threads": str(threads)}
+    simulation, record["context_s"] = timed(
+        openmm.app.Simulation, pdb.topology, system, integrator, platform, properties
+    )
+    simulation.context.setPositions(pdb.positions)
+    _, record["minimization_s"] = timed(simulation.minimizeEnergy)
+    simulation.context.setVelocitiesToTemperature(TEMPERATURE)
+
+    def production():
+        simulation.step(n_steps)
+        # the steps run asynchronously until the state is read back
+        simulation.context.getState(getEnergy=True)
+
+    simulation.step(n_warmup)
+    _, record["production_s"] = timed(production)
+    record["ns_per_day"] = n_steps * time_step * 1e-6 / (record["production_s"] / 86400)
+
+    # the same steps again with the reporter of the notebook
+    simulation.reporters.append(
+        openmm.app.StateDataReporter(
+            io.StringIO(),
+            report_interval,
+            step=True,
+            potentialEnergy=True,
+            temperature=True,
+            density=True,
+        )
+    )
+    _, reported_seconds = timed(production)
+    record["reporter_overhead_s"] = reported_seconds - record["production_s"]
+    record["reporter_overhead"] = record["reporter_overhead_s"] / record["production_s"]
+    potential = (
+        simulation.context.getState(getEnergy=True)
+        .getPotentialEnergy()
+        .value_in_unit(openmm.unit.kilojoule_per_mole)
+    )
+    if not np.isfinite(potential):
+        raise ValueError("non-finite potential energy")
+    return record
+
+
+@click.command()
+@click.option(
+    "-ff",
+    "--ff",
+    "ff_names",
+    type=click.STRING,
+    multiple=True,
+    default=[
+        "../../../openff-2.1.0rc.offxml",
+        "../../../openff_unconstrained-2.1.0rc.offxml",
+    ],
+)
+@click.option(
+    "-p",
+    "--protocol",
+    "protocols",
+    type=click.Choice(list(PROTOCOLS)),
+    multiple=True,
+    default=list(PROTOCOLS),
+)
+@click.option(
+    "-ns",
+    "--n_steps",
+    "n_steps",
+    type=click.INT,
+    default=5000,
+)
+@click.option(
+    "-nw",
+    "--n_warmup",
+    "n_warmup",
+    type=click.INT,
+    default=500,
+)
+@click.option(
+    "-ri",
+    "--report_interval",
+    "report_interval",
+    type=click.INT,
+    default=10,
+)
+@click.option(
+    "-nt",
+    "--threads",
+    "threads",
+    type=click.INT,
+    default=None,
+)
+@click.option(
+    "-sc",
+    "--system_cache",
+    "system_cache",
+    type=click.STRING,
+    default=None,
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    type=click.STRING,
+    default="throughput.json",
+)
+def main(
+    ff_names,
+    protocols,
+    n_steps,
+    n_warmup,
+    report_interval,
+    threads,
+    system_cache,
+    output_file,
+):
+    pdb = openmm.app.PDBFile("solvated.pdb")
+    records = []
+    for ff_name in ff_names:
+        for protocol in protocols:
+            try:
+                record = run_case(
+                    ff_name,
+                    protocol,
+                    pdb,
+                    n_steps,
+                    n_warmup,
+                    report_interval,
+                    threads,
+                    system_cache,
+                )
+            except Exception as error:
+                # e.g. 4 fs without constraints on the hydrogens
+                record = {
+                    "force_field": ff_name,
+                    "protocol": protocol,
+                    "error": f"{type(error).__name__}: {error}",
+                }
+            records.append(record)
+            print(
+                f"{os.path.basename(ff_name):45s} {protocol:8s} "
+                + (
+                    f"{record['ns_per_day']:8.2f} ns/day, setup "
+                    f"{record['setup_s']:.1f} s, reporter overhead "
+                    f"{100 * record['reporter_overhead']:.1f}%"
+                    if "error" not in record
+                    else record["error"]
+                )
+            )
+
+    with open(output_file, "w") as file:
+        json.dump(records, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Minimize the QM conformers of a directory of sdf files with one or more force fields
+import csv
+import logging
+import os
+import sys
+from multiprocessing import Pool
+from pathlib import Path
+
+import click
+import openmm
+from openff.toolkit.topology import Molecule
+from openff.toolkit.typing.engines.smirnoff import ForceField
+from openff.units import unit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "industry_benchmark_set",
+    ),
+)
+from metric_kernels import batched_rmsd
+from system_cache import cached_system, force_field_hash
+
+offlogger = logging.getLogger("openff")
+offlogger.setLevel(logging.ERROR)
+offlogger.propagate = False
+
+CSV_COLUMNS = [
+    "File",
+    "Molecule",
+    "Force Field",
+    "Conformer",
+    "Initial PE (kcal/mol)",
+    "Minimized PE (kcal/mol)",
+    "RMS between initial and minimized conformer (Angstrom)",
+]
+
+
+def read_conformers(sdf_file):
+    """The records of an sdf file as conformers of the molecule of the first one."""
+    molecules = Molecule.from_file(
+        str(sdf_file), file_format="sdf", allow_undefined_stereo=True
+    )
+    if isinstance(molecules, Molecule):
+        molecules = [molecules]
+    molecule = Molecule(molecules[0])
+    for other in molecules[1:]:
+        molecule.add_conformer(other.conformers[0])
+    return molecule
+
+
+def minimize_file(job):
+    """Minimize every conformer of an sdf file, reusing one context for all of them."""
+    sdf_file, ff_name, ff_hash, output_directory, system_cache = job
+    try:
+        molecule = read_conformers(sdf_file)
+        system = cached_system(
+            system_cache,
+            ff_hash,
+            molecule,
+            {"method": "create_openmm_system"},
+            lambda: ForceField(ff_name, load_plugins=True).create_openmm_system(
+                molecule.to_topology()
+            ),
+        )
+    except Exception as error:
+        print(
+            sdf_file, ff_name, "Failed to set up:", f"{type(error).__name__}: {error}"
+        )
+        return []
+    integrator = openmm.VerletIntegrator(0.001)
+    platform = openmm.Platform.getPlatformByName("CPU")
+    context = openmm.Context(system, integrator, platform, {"Threads": "1"})
+
+    # the molecule without its conformers, copied for each minimized one
+    template = molecule.to_dict()
+    template["conformers"] = None
+    rows = []
+    for index, conformer in enumerate(molecule.conformers):
+        initial = conformer.m_as(unit.nanometer)
+        context.setPositions(initial)
+        initial_energy = (
+            context.getState(getEnergy=True)
+            .getPotentialEnergy()
+            .value_in_unit(openmm.unit.kilocalorie_per_mole)
+        )
+        openmm.LocalEnergyMinimizer.minimize(context)
+        state = context.getState(getEnergy=True, getPositions=True)
+        minimized = state.getPositions(asNumpy=True).value_in_unit(
+            openmm.unit.nanometer
+        )
+        minimized_molecule = Molecule.from_dict(template)
+        minimized_molecule.add_conformer(unit.Quantity(minimized, unit.nanometer))
+        minimized_molecule.to_file(
+            os.path.join(
+                output_directory,
+                f"{sdf_file.stem}_{Path(ff_name).stem}_conf{index + 1}_minimized.sdf",
+            ),
+            file_format="sdf",
+        )
+        rows.append(
+            {
+                "File": sdf_file.name,
+                "Molecule": molecule.name,
+                "Force Field": ff_name,
+                "Conformer": index + 1,
+                "Initial PE (kcal/mol)": round(initial_energy, 3),
+                "Minimized PE (kcal/mol)": round(
+                    state.getPotentialEnergy().value_in_unit(
+                        openmm.unit.kilocalorie_per_mole
+                    ),
+                    3,
+                ),
+                "RMS between initial and minimized conformer (Angstrom)": round(
+                    10 * batched_rmsd(initial[None], minimized[None])[0], 3
+                ),
+            }
+        )
+    return rows
+
+
+@click.command()
+@click.option(
+    "-i",
+    "--input_dir",
+    "input_directory",
+    type=click.STRING,
+    default=".",
+)
+@click.option(
+    "-ff",
+    "--ff",
+    "ff_names",
+    type=click.STRING,
+    multiple=True,
+    default=["openff_unconstrained-2.1.0.offxml"],
+)
+@click.option(
+    "-o",
+    "--output_dir",
+    "output_directory",
+    type=click.STRING,
+    default="minimized",
+)
+@click.option(
+    "-csv",
+    "--csv",
+    "csv_file",
+    type=click.STRING,
+    default="minimized-conformers.csv",
+)
+@click.option(
+    "-np",
+    "--n_processes",
+    "n_processes",
+    type=click.INT,
+    default=os.cpu_count(),
+)
+@click.option(
+    "-sc",
+    "--system_cache",
+    "system_cache",
+    type=click.STRING,
+    default="system-cache",
+)
+def main(
+    input_directory, ff_names, output_directory, csv_file, n_processes, system_cache
+):
+    # the minimized sdf files of earlier runs are not inputs
+    sdf_files = sorted(
+        sdf_file
+        for sdf_file in Path(input_directory).glob("*.sdf")
+        if not sdf_file.stem.endswith("_minimized")
+    )
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    ff_hashes = {ff_name: force_field_hash(ff_name) for ff_name in ff_names}
+    jobs = [
+        (
+            sdf_file,
+            ff_name,
+            ff_hashes[ff_name],
+            output_directory,
+            system_cache or None,
+        )
+        for ff_name in ff_names
+        for sdf_file in sdf_files
+    ]
+    print(
+        f"Minimizing the conformers of {len(sdf_files)} sdf files with "
+        f"{len(ff_names)} force fields"
+    )
+
+    rows = []
+    with Pool(n_processes) as pool:
+        for file_rows in pool.imap_unordered(minimize_file, jobs):
+            rows += file_rows
+    rows.sort(key=lambda row: (row["Force Field"], row["File"], row["Conformer"]))
+    with open(csv_file, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
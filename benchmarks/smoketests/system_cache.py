@@ -0,0 +1,66 @@
+"""
+Cache of the OpenMM systems of the smoke tests.
+
+Creating the system of a molecule from a SMIRNOFF force field, charges
+included, takes longer than most of the smoke tests themselves. The systems
+are serialized to XML in a cache directory under a key made of the hash of the
+offxml, the mapped SMILES of the molecule (which fixes the atom order of the
+system) and the keyword arguments of the system generator, so a test run again
+after a change to the code or the integrator settings reads its systems back
+instead of parameterizing the molecules again.
+"""
+import hashlib
+import json
+import os
+
+import openmm
+
+
+def force_field_hash(ff_name):
+    """Hash of an offxml file, or of an installed force field by name."""
+    if os.path.exists(ff_name):
+        with open(ff_name, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    from openff.toolkit.typing.engines.smirnoff import ForceField
+
+    return hashlib.sha256(
+        ForceField(ff_name, load_plugins=True).to_string().encode()
+    ).hexdigest()
+
+
+def system_key(ff_hash, molecule, generator_kwargs):
+    payload = json.dumps(
+        {
+            "force_field": ff_hash,
+            "molecule": molecule.to_smiles(mapped=True),
+            # constraints and quantities are keyed by their repr
+            "kwargs": generator_kwargs,
+        },
+        sort_keys=True,
+        default=repr,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_system(cache_directory, ff_hash, molecule, generator_kwargs, create):
+    """
+    The system of the molecule from the cache, or from create() when it is not
+    cached yet, which is then written to the cache.
+    """
+    if cache_directory is None:
+        return create()
+    file_name = os.path.join(
+        cache_directory, system_key(ff_hash, molecule, generator_kwargs) + ".xml"
+    )
+    if os.path.exists(file_name):
+        with open(file_name) as file:
+            return openmm.XmlSerializer.deserialize(file.read())
+
+    system = create()
+    os.makedirs(cache_directory, exist_ok=True)
+    # written under a temporary name so a concurrent reader never sees half a file
+    temporary_file = f"{file_name}.{os.getpid()}"
+    with open(temporary_file, "w") as file:
+        file.write(openmm.XmlSerializer.serialize(system))
+    os.replace(temporary_file, file_name)
+    return system
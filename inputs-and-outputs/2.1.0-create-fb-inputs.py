@@ -1,7 +1,15 @@
+import hashlib
+import heapq
 import json
+import math
 import os.path
+import re
+import shutil
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
+import click
+import numpy as np
 from openff.bespokefit.optimizers.forcebalance import ForceBalanceInputFactory
 from openff.bespokefit.schema.fitting import OptimizationSchema, OptimizationStageSchema
 from openff.bespokefit.schema.optimizers import ForceBalanceSchema
@@ -26,10 +34,545 @@ from openff.qcsubmit.results.filters import (
     SMARTSFilter,
     SMILESFilter,
 )
+from openff.toolkit.topology import Molecule
 from openff.toolkit.typing.engines.smirnoff import ForceField
 
+QCA_ADDRESS = "https://api.qcarchive.molssi.org:443/"
+TARGET_HASH_FILE = "target-hash.json"
+OPTIONS_HASH_FILE = "options-hash.json"
+TARGET_PARAMETERS_FILE = "target-parameters.json"
 
-def main():
+
+def hash_payload(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def target_hash(target_schema, entries):
+    """
+    Hash of the records a target is built from together with the settings it is
+    generated with, the reference data itself is represented by the records.
+    """
+    return hash_payload(
+        {
+            "records": sorted((entry.record_id, entry.cmiles) for entry in entries),
+            "settings": json.loads(target_schema.json(exclude={"reference_data"})),
+        }
+    )
+
+
+def options_hash(stage, initial_force_field):
+    with open(initial_force_field) as file:
+        force_field_contents = file.read()
+    return hash_payload(
+        {
+            "stage": json.loads(stage.json(exclude={"targets"})),
+            "initial_force_field": force_field_contents,
+        }
+    )
+
+
+def read_target_hashes(root_directory):
+    stamps = {}
+    for stamp_file in Path(root_directory, "targets").glob(f"*/{TARGET_HASH_FILE}"):
+        with open(stamp_file) as file:
+            stamps[stamp_file.parent.name] = json.load(file)
+    return stamps
+
+
+def read_optimize_in(file_name):
+    """Split an optimize.in file into its options section and its $target blocks."""
+    with open(file_name) as file:
+        contents = file.read()
+    blocks = {}
+    header = contents
+    for match in re.finditer(r"^\$target\n.*?^\$end\n", contents, re.M | re.S):
+        if not blocks:
+            header = contents[: match.start()]
+        name = re.search(r"^name\s+(\S+)", match.group(0), re.M).group(1)
+        blocks[name] = match.group(0)
+    return header, blocks
+
+
+def write_optimize_in(file_name, header, blocks):
+    with open(file_name, "w") as file:
+        file.write(header + "\n".join(blocks))
+
+
+def is_fresh(packed_file, source_file):
+    return (
+        packed_file.exists()
+        and packed_file.stat().st_mtime >= source_file.stat().st_mtime
+    )
+
+
+def read_xyz_frames(file_name):
+    with open(file_name) as file:
+        lines = file.read().splitlines()
+    frames = []
+    i = 0
+    while i < len(lines):
+        if lines[i].strip() == "":
+            i += 1
+            continue
+        n_atoms = int(lines[i])
+        frames.append(
+            [
+                [float(x) for x in line.split()[1:4]]
+                for line in lines[i + 2 : i + 2 + n_atoms]
+            ]
+        )
+        i += n_atoms + 2
+    return np.array(frames, dtype=np.float64)
+
+
+def read_qdata_energies(file_name):
+    """
+    The coordinates and energies of a qdata.txt file, or None if it holds any
+    other reference data.
+    """
+    coordinates, energies = [], []
+    with open(file_name) as file:
+        for line in file:
+            words = line.split()
+            if len(words) == 0 or words[0] == "JOB":
+                continue
+            elif words[0] == "COORDS":
+                coordinates.append(np.array(words[1:], dtype=np.float64).reshape(-1, 3))
+            elif words[0] == "ENERGY":
+                energies.append(float(words[1]))
+            else:
+                return None
+    return np.array(coordinates), np.array(energies)
+
+
+def pack_coordinates(target_directory):
+    """
+    Write the frames of every xyz file of a target to a (n_frames, n_atoms, 3)
+    array file next to it, and for torsion targets the QM energies of the
+    frames, which the workers memory-map instead of parsing text.
+    """
+    for xyz_file in Path(target_directory).glob("*.xyz"):
+        packed_file = xyz_file.with_suffix(".npy")
+        if not is_fresh(packed_file, xyz_file):
+            np.save(packed_file, read_xyz_frames(xyz_file))
+
+    scan_file = Path(target_directory, "scan.npy")
+    qdata_file = Path(target_directory, "qdata.txt")
+    energies_file = Path(target_directory, "qm_energies.npy")
+    if scan_file.exists() and qdata_file.exists():
+        if not is_fresh(energies_file, qdata_file):
+            reference = read_qdata_energies(qdata_file)
+            scan = np.load(scan_file)
+            # only usable in place of qdata.txt when the frames are the same
+            if (
+                reference is not None
+                and reference[0].shape == scan.shape
+                and np.allclose(reference[0], scan)
+            ):
+                np.save(energies_file, reference[1])
+
+
+def label_target_parameters(target_directory, force_field, force_field_hash):
+    """
+    Write the SMIRKS of the parameters applied to each molecule of a target, which
+    fb-fit/run_forcebalance.py uses to differentiate every target only with
+    respect to the parameters it depends on.
+    """
+    parameters_file = Path(target_directory, TARGET_PARAMETERS_FILE)
+    if parameters_file.exists():
+        with open(parameters_file) as file:
+            if json.load(file)["force_field"] == force_field_hash:
+                return
+
+    molecules = {}
+    for sdf_file in sorted(Path(target_directory).glob("*.sdf")):
+        molecule = Molecule.from_file(
+            str(sdf_file), file_format="sdf", allow_undefined_stereo=True
+        )
+        labels = force_field.label_molecules(molecule.to_topology())[0]
+        smirks = set()
+        for parameters in labels.values():
+            for parameter in parameters.values():
+                if isinstance(parameter, list):
+                    smirks.update(p.smirks for p in parameter)
+                else:
+                    smirks.add(parameter.smirks)
+        molecules[sdf_file.name] = sorted(smirks)
+    with open(parameters_file, "w") as file:
+        json.dump({"force_field": force_field_hash, "molecules": molecules}, file)
+
+
+def charge_target_molecules(target_directory):
+    """
+    Store the AM1BCC-ELF10 partial charges of the molecules of a target in its
+    sdf files, which fb-fit/fb_targets.py creates the systems of the target with
+    instead of charging the molecules again in every evaluation. Returns the sdf
+    files whose molecules could not be charged, which are left without charges.
+    """
+    failures = []
+    for sdf_file in sorted(Path(target_directory).glob("*.sdf")):
+        molecule = Molecule.from_file(
+            str(sdf_file), file_format="sdf", allow_undefined_stereo=True
+        )
+        # the partial charges are written to a single sdf record, files of
+        # several records or conformers are charged in every evaluation
+        if isinstance(molecule, list):
+            continue
+        if molecule.partial_charges is not None or molecule.n_conformers > 1:
+            continue
+        try:
+            molecule.assign_partial_charges(partial_charge_method="am1bccelf10")
+        except Exception:
+            failures.append(str(sdf_file))
+            continue
+        charged_file = sdf_file.with_suffix(".charged.sdf")
+        molecule.to_file(str(charged_file), file_format="sdf")
+        os.replace(charged_file, sdf_file)
+    return failures
+
+
+def read_target_timings(file_name):
+    """Mean wall time in seconds of each target in a target-timings.json file."""
+    if file_name is None or not os.path.exists(file_name):
+        return {}
+    with open(file_name) as file:
+        timings = json.load(file)
+    return {
+        name: sum(seconds) / len(seconds)
+        for name, seconds in timings.items()
+        if len(seconds) > 0
+    }
+
+
+def count_atoms(cmiles):
+    return len(re.findall(r":\d+\]", cmiles))
+
+
+def estimate_record_costs(entries, stamps, timings):
+    """
+    Estimate the cost of minimizing each optimization record. Every record is a
+    single conformer, and the cost of a minimization is taken to scale with the
+    number of atom pairs. When historical timings of earlier opt-geo batches
+    are available the estimate is calibrated to seconds, otherwise it is only
+    a relative cost.
+    """
+    costs = {entry.record_id: count_atoms(entry.cmiles) ** 2 for entry in entries}
+
+    measured, estimated = 0.0, 0.0
+    for name, seconds in timings.items():
+        if name not in stamps or not name.startswith("opt-geo-batch-"):
+            continue
+        members = [
+            record_id for record_id in stamps[name]["record_ids"] if record_id in costs
+        ]
+        if len(members) == len(stamps[name]["record_ids"]):
+            measured += seconds
+            estimated += sum(costs[record_id] for record_id in members)
+
+    seconds_per_cost = measured / estimated if estimated > 0 else None
+    if seconds_per_cost is not None:
+        costs = {
+            record_id: cost * seconds_per_cost for record_id, cost in costs.items()
+        }
+    return costs, seconds_per_cost is not None
+
+
+def pack_records(entries, costs, n_batches):
+    """
+    Bin-pack the records into batches of roughly equal cost by always adding
+    the most expensive remaining record to the cheapest batch.
+    """
+    batches = [[] for _ in range(n_batches)]
+    heap = [(0.0, i) for i in range(n_batches)]
+    for entry in sorted(
+        entries, key=lambda entry: costs[entry.record_id], reverse=True
+    ):
+        load, i = heapq.heappop(heap)
+        batches[i].append(entry)
+        heapq.heappush(heap, (load + costs[entry.record_id], i))
+    return [batch for batch in batches if len(batch) > 0]
+
+
+def batch_opt_geo_records(stamps, entries, batching, timings):
+    """
+    Assign optimization records to opt-geo batches. Existing batches that were
+    created with the same batching settings keep their members so that
+    excluding a record only rewrites the batch it belonged to, instead of
+    shifting every later batch; new records go into new batches.
+
+    With the "count" mode records are chopped into batches of ``batch_size``,
+    with the "cost" mode they are bin-packed into batches of roughly equal
+    estimated cost, aiming at ``target_seconds`` of work per batch when the
+    cost model could be calibrated against historical timings and at the
+    number of batches ``batch_size`` would give otherwise.
+    """
+    entries_by_id = {entry.record_id: entry for entry in entries}
+    batches = {}
+    assigned = set()
+    batch_names = sorted(
+        (
+            name
+            for name, stamp in stamps.items()
+            if name.startswith("opt-geo-batch-")
+            and stamp.get(
+                "batching", {"batch_size": batching["batch_size"], "mode": "count"}
+            )
+            == batching
+        ),
+        key=lambda name: int(name.rsplit("-", 1)[1]),
+    )
+    for name in batch_names:
+        members = [
+            entries_by_id[record_id]
+            for record_id in stamps[name]["record_ids"]
+            if record_id in entries_by_id and record_id not in assigned
+        ]
+        if members:
+            batches[name] = members
+            assigned.update(entry.record_id for entry in members)
+
+    unassigned = [
+        entry for record_id, entry in entries_by_id.items() if record_id not in assigned
+    ]
+    if batching["mode"] == "count":
+        new_batches = [
+            unassigned[i : i + batching["batch_size"]]
+            for i in range(0, len(unassigned), batching["batch_size"])
+        ]
+    elif batching["mode"] == "cost":
+        costs, calibrated = estimate_record_costs(
+            entries_by_id.values(), stamps, timings
+        )
+        if calibrated:
+            n_batches = math.ceil(
+                sum(costs[entry.record_id] for entry in unassigned)
+                / batching["target_seconds"]
+            )
+        else:
+            n_batches = math.ceil(len(unassigned) / batching["batch_size"])
+        new_batches = pack_records(unassigned, costs, max(n_batches, 1))
+    else:
+        raise ValueError(f"unknown opt-geo batching mode {batching['mode']}")
+
+    next_index = (
+        int(batch_names[-1].rsplit("-", 1)[1]) + 1 if len(batch_names) > 0 else 0
+    )
+    for i, batch in enumerate(new_batches):
+        batches[f"opt-geo-batch-{next_index + i}"] = batch
+    return batches
+
+
+def opt_geo_batching(target_schema, batching):
+    return {"batch_size": target_schema.extras["batch_size"], **batching}
+
+
+def plan_targets(stage, stamps, batching, timings):
+    """Map the name of every target the stage should produce to its schema and records."""
+    planned = {}
+    for target_schema in stage.targets:
+        entries = target_schema.reference_data.entries[QCA_ADDRESS]
+        if isinstance(target_schema, TorsionProfileTargetSchema):
+            for entry in entries:
+                planned[f"torsion-{entry.record_id}"] = (target_schema, [entry])
+        elif isinstance(target_schema, OptGeoTargetSchema):
+            batches = batch_opt_geo_records(
+                stamps, entries, opt_geo_batching(target_schema, batching), timings
+            )
+            for name, batch in batches.items():
+                planned[name] = (target_schema, batch)
+        else:
+            raise TypeError(
+                f"{type(target_schema).__name__} targets can not be planned"
+            )
+    return planned
+
+
+def subset_target(target_schema, entries):
+    reference_data = target_schema.reference_data.copy(deep=True)
+    reference_data.entries = {QCA_ADDRESS: list(entries)}
+    update = {"reference_data": reference_data}
+    if isinstance(target_schema, OptGeoTargetSchema):
+        update["extras"] = {**target_schema.extras, "batch_size": len(entries)}
+    return target_schema.copy(update=update)
+
+
+def generate_targets(
+    root_directory, stage, initial_force_field, planned, names, batching
+):
+    """
+    Generate the named targets in a staging directory, move them into the target
+    tree under their planned names and return their optimize.in blocks together
+    with the staging options section.
+    """
+    torsion_names = [
+        name
+        for name in names
+        if isinstance(planned[name][0], TorsionProfileTargetSchema)
+    ]
+    # torsion targets are named after their record, so all of them can be
+    # generated at once, opt-geo batches are generated one at a time to keep
+    # the planned batch membership
+    jobs = [[name] for name in names if name not in torsion_names]
+    if len(torsion_names) > 0:
+        jobs.insert(0, torsion_names)
+
+    header, blocks = None, {}
+    with TemporaryDirectory(dir=root_directory, prefix=".staging-") as staging:
+        for i, job in enumerate(jobs):
+            target_schema = planned[job[0]][0]
+            entries = [entry for name in job for entry in planned[name][1]]
+            staging_root = os.path.join(staging, str(i))
+            ForceBalanceInputFactory.generate(
+                staging_root,
+                stage.copy(update={"targets": [subset_target(target_schema, entries)]}),
+                ForceField(initial_force_field),
+            )
+            header, staged_blocks = read_optimize_in(
+                os.path.join(staging_root, "optimize.in")
+            )
+            renames = (
+                {name: name for name in job}
+                if len(job) > 1 or job[0] in staged_blocks
+                else {job[0]: next(iter(staged_blocks))}
+            )
+            for name, staged_name in renames.items():
+                destination = os.path.join(root_directory, "targets", name)
+                shutil.rmtree(destination, ignore_errors=True)
+                shutil.move(
+                    os.path.join(staging_root, "targets", staged_name), destination
+                )
+                stamp = {
+                    "hash": target_hash(*planned[name]),
+                    "record_ids": [entry.record_id for entry in planned[name][1]],
+                }
+                if isinstance(target_schema, OptGeoTargetSchema):
+                    stamp["batching"] = opt_geo_batching(target_schema, batching)
+                with open(os.path.join(destination, TARGET_HASH_FILE), "w") as file:
+                    json.dump(stamp, file)
+                blocks[name] = re.sub(
+                    r"^name\s+\S+$",
+                    f"name {name}",
+                    staged_blocks[staged_name],
+                    flags=re.M,
+                )
+            if i == len(jobs) - 1:
+                forcefield_directory = os.path.join(root_directory, "forcefield")
+                shutil.rmtree(forcefield_directory, ignore_errors=True)
+                shutil.move(
+                    os.path.join(staging_root, "forcefield"), forcefield_directory
+                )
+    return header, blocks
+
+
+def update_force_balance_inputs(
+    root_directory, stage, initial_force_field, batching, timings
+):
+    """
+    Bring a ForceBalance input tree in line with the stage. Every target directory
+    is stamped with a hash of its source records and generation settings, so
+    only the targets whose inputs changed are regenerated, targets that are no
+    longer planned are removed and the optimize.in $target blocks are patched to
+    match.
+    """
+    Path(root_directory, "targets").mkdir(parents=True, exist_ok=True)
+    stamps = read_target_hashes(root_directory)
+    planned = plan_targets(stage, stamps, batching, timings)
+
+    changed = [
+        name
+        for name, (target_schema, entries) in planned.items()
+        if stamps.get(name, {}).get("hash") != target_hash(target_schema, entries)
+    ]
+    removed = [
+        path.name
+        for path in Path(root_directory, "targets").iterdir()
+        if path.is_dir() and path.name not in planned
+    ]
+
+    optimize_in = os.path.join(root_directory, "optimize.in")
+    header, blocks = (
+        read_optimize_in(optimize_in) if os.path.exists(optimize_in) else (None, {})
+    )
+    current_options_hash = options_hash(stage, initial_force_field)
+    options_stamp = os.path.join(root_directory, OPTIONS_HASH_FILE)
+    previous_options_hash = None
+    if os.path.exists(options_stamp):
+        with open(options_stamp) as file:
+            previous_options_hash = json.load(file)["hash"]
+    if len(changed) == 0 and (
+        header is None or previous_options_hash != current_options_hash
+    ):
+        # regenerate the cheapest target to refresh the options and force field
+        changed = [min(planned, key=lambda name: len(planned[name][1]))]
+
+    print(
+        f"{len(changed)} targets to generate, {len(removed)} to remove and "
+        f"{len(planned) - len(changed)} unchanged"
+    )
+    for name in removed:
+        shutil.rmtree(os.path.join(root_directory, "targets", name))
+    if len(changed) > 0:
+        header, generated_blocks = generate_targets(
+            root_directory, stage, initial_force_field, planned, changed, batching
+        )
+        blocks.update(generated_blocks)
+    force_field = ForceField(initial_force_field)
+    with open(initial_force_field) as file:
+        force_field_hash = hash_payload(file.read())
+    charging_failures = []
+    for name in planned:
+        target_directory = os.path.join(root_directory, "targets", name)
+        pack_coordinates(target_directory)
+        charging_failures += charge_target_molecules(target_directory)
+        label_target_parameters(target_directory, force_field, force_field_hash)
+    for sdf_file in charging_failures:
+        print(f"AM1BCC-ELF10 charging failed for {sdf_file}")
+
+    write_optimize_in(optimize_in, header, [blocks[name] for name in planned])
+    with open(options_stamp, "w") as file:
+        json.dump({"hash": current_options_hash}, file)
+
+
+# opt-geo batches are either chopped by record count or bin-packed by estimated
+# cost, aiming at target_seconds per batch when the cost model can be calibrated
+# with the historical target timings
+@click.command()
+@click.option(
+    "-bm",
+    "--batch_mode",
+    "batch_mode",
+    type=click.Choice(["count", "cost"]),
+    default="count",
+)
+@click.option(
+    "-ts",
+    "--target_seconds",
+    "target_seconds",
+    type=click.FLOAT,
+    default=1800.0,
+)
+@click.option(
+    "-tt",
+    "--target_timings",
+    "target_timings",
+    type=click.STRING,
+    default="fb-fit/target-timings.json",
+)
+@click.option(
+    "-ex",
+    "--wq_executor",
+    "wq_executor",
+    type=click.Choice(["workqueue", "local"]),
+    default="workqueue",
+)
+@click.option(
+    "-nw",
+    "--wq_local_workers",
+    "wq_local_workers",
+    type=click.INT,
+    default=None,
+)
+def main(batch_mode, target_seconds, target_timings, wq_executor, wq_local_workers):
     Path("./schemas/optimizations/").mkdir(parents=True, exist_ok=True)
     tag = "fb-fit"
     port_number = 55387
@@ -198,6 +741,20 @@ def main():
         ],
     ]
 
+    optimizer_extras = {
+        "wq_port": str(port_number),
+        "asynchronous": "True",
+        "search_tolerance": "0.1",
+        "backup": "0",
+        "retain_micro_outputs": "0",
+    }
+    if wq_executor == "local":
+        # evaluate the remote targets on a local process pool, these options
+        # are read by fb-fit/run_forcebalance.py rather than ForceBalance
+        optimizer_extras["wq_executor"] = wq_executor
+        if wq_local_workers is not None:
+            optimizer_extras["wq_local_workers"] = str(wq_local_workers)
+
     # Define the full schema for the optimization.
     optimization_schema = OptimizationSchema(
         id=tag,
@@ -213,13 +770,7 @@ def main():
                     n_criteria=2,
                     initial_trust_radius=-1.0,
                     finite_difference_h=0.01,
-                    extras={
-                        "wq_port": str(port_number),
-                        "asynchronous": "True",
-                        "search_tolerance": "0.1",
-                        "backup": "0",
-                        "retain_micro_outputs": "0",
-                    },
+                    extras=optimizer_extras,
                 ),
                 # Define the torsion profile targets to fit against.
                 targets=[
@@ -257,11 +808,17 @@ def main():
     ) as file:
         file.write(optimization_schema.json())
 
-    # Generate the ForceBalance inputs
-    ForceBalanceInputFactory.generate(
+    # Generate the ForceBalance inputs, only the targets whose records or
+    # settings changed since the last run are regenerated
+    batching = {"mode": batch_mode}
+    if batch_mode == "cost":
+        batching["target_seconds"] = target_seconds
+    update_force_balance_inputs(
         os.path.join(optimization_schema.id),
         optimization_schema.stages[0],
-        ForceField(optimization_schema.initial_force_field),
+        optimization_schema.initial_force_field,
+        batching,
+        read_target_timings(target_timings),
     )
 
 
@@ -0,0 +1,501 @@
+"""
+Work Queue scheduling for the remote ForceBalance targets of the Sage fit.
+
+ForceBalance submits the remote targets in declaration order and an objective
+evaluation lasts as long as its slowest task. The helpers here keep a small
+timing database of the targets, submit the targets longest-processing-time
+first and, once workers go idle, send speculative duplicates of the slowest
+outstanding tasks. The inputs that stay the same between evaluations are
+declared cacheable under content-addressed names, so workers keep them across
+tasks and iterations. They also provide a local process pool with the Work Queue
+task interface, so the remote targets can be evaluated on a single node
+without a master/worker setup.
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+import forcebalance.nifty
+import forcebalance.objective
+import forcebalance.target
+from forcebalance.output import getLogger
+
+logger = getLogger(__name__)
+
+TaskSpec = namedtuple("TaskSpec", ["command", "input_files", "output_files", "tag"])
+
+# the remote targets are run by remote_target.py, which sets up the extensions
+# of fb_targets.py on the worker before running the rtarget.py of ForceBalance
+WORKER_SCRIPTS = ["remote_target.py", "fb_targets.py"]
+
+# inputs of the remote targets which are the same for every objective evaluation,
+# only forcefield.p and options.p with the parameters and the iteration change
+CACHED_INPUTS = {"rtarget.py", "target.tar.bz2", *WORKER_SCRIPTS}
+
+# inputs a remote target sends along when they are in its directory, such as the
+# minimized geometries of the previous iteration
+OPTIONAL_INPUTS = ["mm_geometries.npz"]
+
+INPUT_CACHE = None
+
+
+class TargetTimings:
+    """Wall times of the remote target tasks over the last few evaluations."""
+
+    def __init__(self, file_name, history=10):
+        self.file_name = file_name
+        self.history = history
+        self.seconds = {}
+        if os.path.exists(file_name):
+            with open(file_name) as file:
+                self.seconds = json.load(file)
+
+    def record(self, name, seconds):
+        self.seconds[name] = [*self.seconds.get(name, []), seconds][-self.history :]
+
+    def expected(self, name):
+        seconds = self.seconds.get(name, [])
+        if len(seconds) == 0:
+            return None
+        return sum(seconds) / len(seconds)
+
+    def write(self):
+        with open(self.file_name + ".tmp", "w") as file:
+            json.dump(self.seconds, file)
+        os.replace(self.file_name + ".tmp", self.file_name)
+
+
+def order_targets(objective, timings):
+    """
+    Sort the targets of the objective longest expected wall time first, which
+    is the order they are staged and submitted to Work Queue in. Targets
+    without any timing are assumed to be as slow as the slowest known one.
+    """
+    known = [timings.expected(tgt.name) for tgt in objective.Targets]
+    slowest = max((seconds for seconds in known if seconds is not None), default=0.0)
+    objective.Targets.sort(
+        key=lambda tgt: timings.expected(tgt.name) or slowest, reverse=True
+    )
+
+
+def file_digest(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class InputCache:
+    """
+    Content-addressed copies of the task inputs. Work Queue workers keep a
+    cached input under its local file name, so giving every version of a file
+    its own name lets the workers reuse it across tasks and iterations, and
+    fetch it again from the master only when its content changes.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        # (file name, size, modification time) -> content-addressed copy
+        self.staged = {}
+
+    def stage(self, file_name):
+        stat = os.stat(file_name)
+        key = (file_name, stat.st_size, stat.st_mtime_ns)
+        if key not in self.staged:
+            cached = os.path.join(
+                self.directory, file_digest(file_name), os.path.basename(file_name)
+            )
+            if not os.path.exists(cached):
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                # copied rather than linked, ForceBalance rewrites the tarballs in
+                # place when a run is started again in the same directory
+                shutil.copy(file_name, cached + ".tmp")
+                os.replace(cached + ".tmp", cached)
+            self.staged[key] = cached
+        return self.staged[key]
+
+
+def task_input(local_file, remote_file):
+    """The (local file, remote file, cache) specification of a task input."""
+    local_file = os.path.abspath(local_file)
+    if INPUT_CACHE is None or os.path.basename(remote_file) not in CACHED_INPUTS:
+        return local_file, remote_file, False
+    return INPUT_CACHE.stage(local_file), remote_file, True
+
+
+def create_task(spec):
+    task = forcebalance.nifty.work_queue.Task(spec.command)
+    for local_file, remote_file, cache in spec.input_files:
+        task.specify_input_file(local_file, remote_file, cache=cache)
+    for local_file, remote_file in spec.output_files:
+        task.specify_output_file(local_file, remote_file, cache=False)
+    task.specify_tag(spec.tag)
+    # a worker can run as many target tasks at once as it has cores, all of them
+    # sharing the inputs cached by that worker
+    task.specify_cores(1)
+    return task
+
+
+def queue_up(
+    wq,
+    command,
+    input_files,
+    output_files,
+    tag=None,
+    tgt=None,
+    verbose=True,
+    print_time=60,
+):
+    """
+    Drop-in for forcebalance.nifty.queue_up which keeps the specification of
+    the task with it, so the task can be duplicated later on. Remote targets
+    are run through remote_target.py.
+    """
+    cwd = os.getcwd()
+    inputs = [(file_name, file_name) for file_name in input_files]
+    if "rtarget.py" in input_files:
+        command = command.replace("rtarget.py", "remote_target.py")
+        scripts = os.path.dirname(os.path.abspath(__file__))
+        inputs += [(os.path.join(scripts, name), name) for name in WORKER_SCRIPTS]
+        inputs += [(name, name) for name in OPTIONAL_INPUTS if os.path.exists(name)]
+    spec = TaskSpec(
+        command,
+        [task_input(local_file, remote_file) for local_file, remote_file in inputs],
+        [(os.path.join(cwd, file_name), file_name) for file_name in output_files],
+        command if tag is None else tag,
+    )
+    task = create_task(spec)
+    task.print_time = print_time
+    task.spec = spec
+    taskid = wq.submit(task)
+    if verbose:
+        logger.info(
+            "Submitting command '%s' to the Work Queue, taskid %i\n" % (command, taskid)
+        )
+    forcebalance.nifty.WQIDS["None" if tgt is None else tgt.name].append(taskid)
+
+
+class ScheduledWorkQueue:
+    """
+    Wrapper around the ForceBalance Work Queue that records the wall time of
+    every finished task and submits speculative duplicates of the slowest
+    outstanding tasks once workers go idle. The first copy of a task to
+    finish wins and the other copy is cancelled.
+    """
+
+    def __init__(self, wq, timings, speculate_after=300.0, telemetry=None):
+        self._wq = wq
+        self.timings = timings
+        self.speculate_after = speculate_after
+        self.telemetry = telemetry
+        # taskid -> (task spec, submission time)
+        self.outstanding = {}
+        # taskid -> taskid of the other copy of a duplicated task
+        self.copies = {}
+
+    def __getattr__(self, name):
+        return getattr(self._wq, name)
+
+    def submit(self, task, speculative=False):
+        taskid = self._wq.submit(task)
+        self.outstanding[taskid] = (getattr(task, "spec", None), time.time())
+        if self.telemetry is not None:
+            self.telemetry.task_submitted(task.tag, speculative)
+        return taskid
+
+    def wait(self, timeout):
+        task = self._wq.wait(timeout)
+        if task is None:
+            self.speculate()
+            return None
+
+        _, submitted = self.outstanding.pop(task.id, (None, None))
+        if self.telemetry is not None and submitted is not None:
+            self.telemetry.task_finished(
+                task.tag,
+                task.hostname,
+                task.cmd_execution_time / 1e6,
+                time.time() - submitted,
+                task.result,
+            )
+        other = self.copies.pop(task.id, None)
+        if other is not None:
+            self.copies.pop(other, None)
+
+        if task.result != 0 and other is not None and other in self.outstanding:
+            # the other copy is still running, let it finish on its own
+            self.forget(task.id, other)
+            return None
+
+        if task.result == 0:
+            self.timings.record(task.tag, task.cmd_execution_time / 1e6)
+            if other is not None and other in self.outstanding:
+                logger.info("Cancelling the slower copy of task '%s'\n" % task.tag)
+                self._wq.cancel_by_taskid(other)
+                self.outstanding.pop(other)
+                self.forget(other, task.id)
+            if len(self.outstanding) == 0:
+                self.timings.write()
+        return task
+
+    def forget(self, taskid, replacement):
+        """Swap the id of a dropped copy for the id of the surviving copy."""
+        for taskids in forcebalance.nifty.WQIDS.values():
+            if taskid in taskids:
+                taskids.remove(taskid)
+                if replacement not in taskids:
+                    taskids.append(replacement)
+
+    def speculate(self):
+        """Duplicate the slowest running tasks onto idle workers."""
+        stats = self._wq.stats
+        if stats.tasks_waiting > 0 or stats.workers_idle == 0:
+            return
+
+        now = time.time()
+        candidates = sorted(
+            (
+                (now - submitted, taskid, spec)
+                for taskid, (spec, submitted) in self.outstanding.items()
+                if spec is not None
+                and taskid not in self.copies
+                and now - submitted > self.speculate_after
+            ),
+            reverse=True,
+        )
+        for elapsed, taskid, spec in candidates[: stats.workers_idle]:
+            duplicate = create_task(spec)
+            duplicate.spec = spec
+            duplicateid = self.submit(duplicate, speculative=True)
+            self.copies[taskid] = duplicateid
+            self.copies[duplicateid] = taskid
+            logger.info(
+                "Task '%s' has been running for %i seconds, submitted a "
+                "speculative copy: taskid %i\n" % (spec.tag, elapsed, duplicateid)
+            )
+
+
+def keep_work_queue(wq_port, *args, **kwargs):
+    """
+    Drop-in for forcebalance.nifty.createWorkQueue in the objectives built after
+    the scheduler is installed, such as those of the stages of a staged
+    optimization, which submit to the ScheduledWorkQueue already listening on
+    the port instead of binding another Work Queue to it.
+    """
+    if not isinstance(forcebalance.nifty.WORK_QUEUE, ScheduledWorkQueue):
+        forcebalance.nifty.createWorkQueue(wq_port, *args, **kwargs)
+
+
+def install_scheduler(timings, speculate_after, cache_dir=None, telemetry=None):
+    """
+    Route the remote target tasks through a ScheduledWorkQueue, to be called
+    once the first Objective has created the Work Queue.
+    """
+    global INPUT_CACHE
+    if cache_dir is not None:
+        INPUT_CACHE = InputCache(cache_dir)
+    for module in (forcebalance.nifty, forcebalance.target):
+        if hasattr(module, "queue_up"):
+            module.queue_up = queue_up
+    if forcebalance.nifty.WORK_QUEUE is None:
+        raise RuntimeError("The Work Queue has not been created, is wq_port set?")
+    forcebalance.nifty.WORK_QUEUE = ScheduledWorkQueue(
+        forcebalance.nifty.WORK_QUEUE, timings, speculate_after, telemetry
+    )
+    forcebalance.objective.createWorkQueue = keep_work_queue
+
+
+class LocalTask:
+    """The subset of the work_queue.Task interface ForceBalance uses."""
+
+    def __init__(self, command):
+        self.command = command
+        self.tag = None
+        self.id = None
+        self.input_files = []
+        self.output_files = []
+        self.cores = None
+        self.result = None
+        self.return_status = None
+        self.output = ""
+        self.hostname = socket.gethostname()
+        self.cmd_execution_time = 0
+
+    def specify_input_file(self, local_name, remote_name=None, flags=None, cache=True):
+        self.input_files.append(
+            (local_name, remote_name or os.path.basename(local_name), cache)
+        )
+
+    def specify_output_file(self, local_name, remote_name=None, flags=None, cache=True):
+        self.output_files.append(
+            (local_name, remote_name or os.path.basename(local_name))
+        )
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+    def specify_cores(self, cores):
+        self.cores = cores
+
+
+class LocalWorkQueue:
+    """
+    Runs the Work Queue tasks of ForceBalance on a local pool of worker
+    processes. Each task gets its own sandbox directory in the scratch
+    directory, its input files are copied in (cached inputs are linked, they
+    are already content-addressed files on the same node), its command is run
+    and its output files are copied back, like a work_queue_worker would do.
+    """
+
+    # result codes of work_queue
+    SUCCESS = 0
+    INPUT_MISSING = 1
+    OUTPUT_MISSING = 2
+
+    def __init__(self, workers, port=0, scratch=None, **kwargs):
+        self.workers = workers
+        self.port = port
+        self.scratch = scratch
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.processes = {}
+        self.finished = []
+        self.next_id = 1
+        self.completed = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # specify_name, specify_algorithm, specify_keepalive_timeout, ...
+        # tune the master/worker protocol and mean nothing locally
+        if name.startswith("specify_") or name.startswith("activate_"):
+            return lambda *args, **kwargs: None
+        raise AttributeError(name)
+
+    @property
+    def stats(self):
+        running = sum(future.running() for future in self.futures.values())
+        waiting = sum(
+            not future.running() and not future.done()
+            for future in self.futures.values()
+        )
+        return SimpleNamespace(
+            workers_connected=self.workers,
+            workers_busy=running,
+            workers_idle=self.workers - running,
+            tasks_waiting=waiting,
+            tasks_running=running,
+            total_tasks_complete=self.completed,
+            total_tasks_dispatched=self.next_id - 1,
+            total_workers_joined=self.workers,
+            total_workers_removed=0,
+        )
+
+    def submit(self, task):
+        task.id = self.next_id
+        self.next_id += 1
+        future = self.pool.submit(self.run, task)
+        self.futures[task.id] = future
+        return task.id
+
+    def run(self, task):
+        sandbox = tempfile.mkdtemp(prefix=f"task-{task.id}-", dir=self.scratch)
+        try:
+            for local_name, remote_name, cache in task.input_files:
+                remote_path = os.path.join(sandbox, remote_name)
+                os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+                if cache and os.path.isfile(local_name):
+                    os.symlink(local_name, remote_path)
+                elif os.path.isdir(local_name):
+                    shutil.copytree(local_name, remote_path)
+                elif os.path.exists(local_name):
+                    shutil.copy(local_name, remote_path)
+                else:
+                    task.result = self.INPUT_MISSING
+                    return task
+
+            start = time.time()
+            process = subprocess.Popen(
+                task.command,
+                shell=True,
+                cwd=sandbox,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            with self.lock:
+                self.processes[task.id] = process
+            task.output, _ = process.communicate()
+            task.return_status = process.returncode
+            task.cmd_execution_time = int((time.time() - start) * 1e6)
+
+            task.result = self.SUCCESS
+            for local_name, remote_name in task.output_files:
+                remote_path = os.path.join(sandbox, remote_name)
+                if os.path.exists(remote_path):
+                    shutil.copy(remote_path, local_name)
+                else:
+                    task.result = self.OUTPUT_MISSING
+            return task
+        finally:
+            with self.lock:
+                self.processes.pop(task.id, None)
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+    def wait(self, timeout):
+        if len(self.finished) == 0 and len(self.futures) > 0:
+            wait(self.futures.values(), timeout=timeout, return_when=FIRST_COMPLETED)
+            for taskid, future in list(self.futures.items()):
+                if future.done():
+                    self.finished.append(self.futures.pop(taskid))
+        if len(self.finished) == 0:
+            if len(self.futures) == 0:
+                time.sleep(timeout)
+            return None
+        self.completed += 1
+        return self.finished.pop(0).result()
+
+    def empty(self):
+        return len(self.futures) == 0 and len(self.finished) == 0
+
+    def hungry(self):
+        return len(self.futures) < self.workers
+
+    def cancel_by_taskid(self, taskid):
+        self.finished = [
+            future for future in self.finished if future.result().id != taskid
+        ]
+        future = self.futures.pop(taskid, None)
+        if future is not None and not future.cancel():
+            with self.lock:
+                process = self.processes.get(taskid)
+            if process is not None:
+                process.kill()
+        return future
+
+
+def local_work_queue(workers):
+    """A stand-in for the work_queue module backed by a LocalWorkQueue."""
+    return SimpleNamespace(
+        Task=LocalTask,
+        WorkQueue=lambda *args, **kwargs: LocalWorkQueue(workers, **kwargs),
+        set_debug_flag=lambda *flags: None,
+        WORK_QUEUE_DEFAULT_PORT=0,
+        WORK_QUEUE_RANDOM_PORT=0,
+        WORK_QUEUE_SCHEDULE_FCFS=0,
+        WORK_QUEUE_SCHEDULE_TIME=0,
+    )
+
+
+def install_local_executor(workers):
+    """Make ForceBalance create a LocalWorkQueue instead of a Work Queue master."""
+    forcebalance.nifty.work_queue = local_work_queue(workers)
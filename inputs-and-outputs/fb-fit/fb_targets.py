@@ -0,0 +1,915 @@
+"""
+Loading of the ForceBalance targets of the Sage fit.
+
+The targets directory holds thousands of small target directories, which take
+minutes to extract on the scratch filesystem before an optimization can start.
+The targets are instead kept in a zip archive, whose central directory indexes
+the files of every target, and the files of a target are read straight from
+the archive by target name when its target is set up.
+
+On the workers the remote targets are run by remote_target.py, which installs
+the extensions here before handing over to the rtarget.py of ForceBalance. The
+coordinates of the targets are read from the (n_frames, n_atoms, 3) arrays
+create-fb-inputs packs next to the xyz files, memory-mapped instead of parsed.
+
+Torsion profile targets can be evaluated with TorsionProfileGrid_SMIRNOFF,
+which can seed the relaxation of each grid point from its relaxed neighbour and
+relax the grid points on a thread pool, and TorsionProfileKBasis_SMIRNOFF, which
+also takes the derivatives with respect to the proper torsion force constants
+from a basis of unit-k torsion energies instead of finite differences.
+
+Every target is differentiated only with respect to the parameters applied to
+its molecules, which create-fb-inputs labels once and writes to
+target-parameters.json, instead of labelling the molecules again in every task.
+The same labels pick the subsamples of the targets for the early stages of a
+staged optimization.
+
+The MM minimizations of the optimized geometry targets can start from the
+minimized geometries of the previous evaluation instead of the QM geometries,
+which are sent along with the next task of a remote target.
+
+The AM1BCC-ELF10 charges of the molecules are computed once by create-fb-inputs
+and stored in the sdf files of the targets, and the systems of the targets are
+created with them instead of charging the molecules in every evaluation.
+"""
+import functools
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+import zipfile
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from itertools import chain
+
+import forcebalance.molecule
+import forcebalance.objective
+import forcebalance.smirnoffio
+import forcebalance.target
+import numpy as np
+import openmm
+from forcebalance.finite_difference import f12d3p, fdwrap, in_fd
+from forcebalance.output import getLogger
+from forcebalance.smirnoffio import (
+    OptGeoTarget_SMIRNOFF,
+    TorsionProfileTarget_SMIRNOFF,
+)
+from openff.units import unit
+from openmm import unit as openmm_unit
+
+logger = getLogger(__name__)
+
+TORSION_GRID_TYPE = "TORSIONPROFILEGRID_SMIRNOFF"
+TORSION_K_BASIS_TYPE = "TORSIONPROFILEKBASIS_SMIRNOFF"
+TARGET_PARAMETERS_FILE = "target-parameters.json"
+WARM_START_FILE = "mm_geometries.npz"
+OPT_GEO_TYPES = ("OPTGEO_SMIRNOFF", "OPTGEOTARGET_SMIRNOFF")
+
+
+class TargetArchive:
+    """Zip archive of the targets directory, indexed by target name."""
+
+    def __init__(self, file_name):
+        self.file_name = os.path.abspath(file_name)
+        self.archive = zipfile.ZipFile(self.file_name)
+        # target name -> zip members of the files of the target
+        self.members = defaultdict(list)
+        for info in self.archive.infolist():
+            parts = info.filename.split("/")
+            if len(parts) > 2 and parts[0] == "targets" and not info.is_dir():
+                self.members[parts[1]].append(info)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def target_members(self, name):
+        if name not in self.members:
+            raise RuntimeError(f"Target {name} is not in {self.file_name}")
+        return self.members[name]
+
+    def read(self, name, file_name):
+        return self.archive.read(f"targets/{name}/{file_name}")
+
+    def extract(self, name, root):
+        """Extract the files of one target into root/targets/name."""
+        for info in self.target_members(name):
+            self.archive.extract(info, root)
+
+    def write_tarball(self, name, file_name):
+        """
+        Write the files of one target to a target.tar.bz2 like the one
+        RemoteTarget creates from the target directory. The members keep the
+        time stamps of the zip archive, so the tarball of an unchanged target is
+        the same file in every run.
+        """
+        with tarfile.open(file_name, "w:bz2") as tar:
+            for info in self.target_members(name):
+                data = self.archive.read(info)
+                tar_info = tarfile.TarInfo(info.filename)
+                tar_info.size = len(data)
+                tar_info.mtime = time.mktime(info.date_time + (0, 0, -1))
+                tar_info.mode = 0o644
+                tar.addfile(tar_info, io.BytesIO(data))
+
+
+def pack_targets(targets_dir, file_name):
+    """Write the target directories of targets_dir to a zip archive."""
+    with zipfile.ZipFile(
+        file_name + ".tmp", "w", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        for name in sorted(os.listdir(targets_dir)):
+            target_dir = os.path.join(targets_dir, name)
+            if not os.path.isdir(target_dir):
+                continue
+            for directory, _, files in sorted(os.walk(target_dir)):
+                for file in sorted(files):
+                    path = os.path.join(directory, file)
+                    archive.write(
+                        path,
+                        os.path.join("targets", os.path.relpath(path, targets_dir)),
+                    )
+    os.replace(file_name + ".tmp", file_name)
+
+
+class ArchiveRemoteTarget(forcebalance.target.RemoteTarget):
+    """RemoteTarget which ships the files of its target from the archive."""
+
+    archive = None
+
+    def __init__(self, options, tgt_opts, forcefield):
+        super().__init__(options, tgt_opts, forcefield)
+        # the target directory is empty, replace the tarball made from it
+        self.archive.write_tarball(
+            self.name, os.path.join(self.tempdir, "target.tar.bz2")
+        )
+
+
+def install_target_archive(archive, root, tgt_opts):
+    """
+    Set up the targets of tgt_opts from the archive: remote targets only get
+    an empty target directory, which ForceBalance checks for, and their files
+    are sent to the workers from the archive, local targets have their own
+    files extracted.
+    """
+    for opts in tgt_opts:
+        if opts["remote"]:
+            archive.target_members(opts["name"])
+            os.makedirs(os.path.join(root, "targets", opts["name"]), exist_ok=True)
+        else:
+            archive.extract(opts["name"], root)
+
+    ArchiveRemoteTarget.archive = archive
+    for module in (forcebalance.target, forcebalance.objective):
+        if hasattr(module, "RemoteTarget"):
+            module.RemoteTarget = ArchiveRemoteTarget
+
+
+def packed_file(file_name, packed_name):
+    """The array file packed from file_name next to it, if it is up to date."""
+    packed = os.path.join(os.path.dirname(file_name), packed_name)
+    if os.path.exists(packed) and os.path.getmtime(packed) >= os.path.getmtime(
+        file_name
+    ):
+        return packed
+    return None
+
+
+def read_xyz_elements(file_name):
+    """The elements of the first frame of an xyz file."""
+    with open(file_name) as file:
+        n_atoms = int(file.readline())
+        file.readline()
+        return [file.readline().split()[0] for _ in range(n_atoms)]
+
+
+def read_packed_xyz(read_xyz):
+    @functools.wraps(read_xyz)
+    def wrapper(self, fnm, **kwargs):
+        packed = packed_file(fnm, os.path.splitext(os.path.basename(fnm))[0] + ".npy")
+        if packed is None:
+            return read_xyz(self, fnm, **kwargs)
+        # copy-on-write, so frames changed in place never touch the file
+        frames = np.load(packed, mmap_mode="c")
+        return {"elem": read_xyz_elements(fnm), "xyzs": list(frames)}
+
+    return wrapper
+
+
+def read_packed_qdata(read_qdata):
+    @functools.wraps(read_qdata)
+    def wrapper(self, fnm, **kwargs):
+        # qm_energies.npy is only packed when qdata.txt holds nothing but the
+        # energies of the frames of scan.npy
+        scan = packed_file(fnm, "scan.npy")
+        energies = packed_file(fnm, "qm_energies.npy")
+        if scan is None or energies is None:
+            return read_qdata(self, fnm, **kwargs)
+        return {
+            "xyzs": list(np.load(scan, mmap_mode="c")),
+            "qm_energies": np.load(energies).tolist(),
+        }
+
+    return wrapper
+
+
+def dihedral_angles(xyz, torsions):
+    """Dihedral angles in radians of the (n, 4) atom indices in torsions."""
+    x0, x1, x2, x3 = (xyz[torsions[:, i]] for i in range(4))
+    b0, b1, b2 = x1 - x0, x2 - x1, x3 - x2
+    y = np.linalg.norm(b1, axis=1) * np.sum(b0 * np.cross(b1, b2), axis=1)
+    x = np.sum(np.cross(b0, b1) * np.cross(b1, b2), axis=1)
+    return np.arctan2(y, x)
+
+
+def rotation_matrix(a, b):
+    """The rotation which best superimposes the centered xyz a onto b."""
+    u, _, vt = np.linalg.svd((a - a.mean(0)).T @ (b - b.mean(0)))
+    if np.linalg.det(u @ vt) < 0:
+        u[:, -1] *= -1
+    return u @ vt
+
+
+class TorsionProfileGrid_SMIRNOFF(TorsionProfileTarget_SMIRNOFF):
+    """
+    Torsion profile target which relaxes its grid points with one system per
+    evaluation instead of one per grid point.
+
+    With the grid_seeding target option each grid point starts from the
+    relaxed geometry of the grid point before it, when the two are adjacent
+    on the grid: the relaxation of the neighbour from its QM geometry is
+    rotated onto the QM geometry of the grid point, which keeps the frozen
+    torsion atoms where the scan put them. With grid_threads above 1 the grid
+    points are split into that many chains, relaxed by a thread pool with a
+    copy of the system each. The wall time of every grid point is written to
+    GridTimings.txt.
+    """
+
+    def __init__(self, options, tgt_opts, forcefield):
+        super().__init__(options, tgt_opts, forcefield)
+        self.grid_seeding = tgt_opts.get("grid_seeding", False)
+        self.grid_threads = max(1, tgt_opts.get("grid_threads", 1))
+        self.build_grid_chains()
+
+    def build_grid_chains(self):
+        """
+        Split the grid points, in the order of their grid ids, into a chain for
+        every thread, as (grid point, grid point to seed it from or None).
+        """
+        grid_ids = np.array(self.metadata["torsion_grid_ids"], dtype=float)
+        grid_ids = grid_ids.reshape(self.ns, -1)
+        order = sorted(range(self.ns), key=lambda i: tuple(grid_ids[i]))
+
+        def distance(i, j):
+            difference = np.abs(grid_ids[i] - grid_ids[j]) % 360
+            return np.minimum(difference, 360 - difference).max()
+
+        spacing = min(
+            (distance(i, j) for i, j in zip(order, order[1:]) if distance(i, j) > 0),
+            default=0.0,
+        )
+        self.grid_chains = []
+        for chain_ in np.array_split(order, min(self.grid_threads, self.ns)):
+            chain_ = [int(shot) for shot in chain_]
+            links = [(chain_[0], None)]
+            for previous, shot in zip(chain_, chain_[1:]):
+                adjacent = self.grid_seeding and distance(previous, shot) <= spacing
+                links.append((shot, previous if adjacent else None))
+            self.grid_chains.append(links)
+
+    def grid_contexts(self):
+        """The system and context of the engine, and copies for the other chains."""
+        simulation = self.engine.simulation
+        contexts = [(simulation.system, simulation.context, simulation.integrator)]
+        for _ in self.grid_chains[1:]:
+            system = openmm.XmlSerializer.clone(simulation.system)
+            integrator = openmm.VerletIntegrator(1.0)
+            context = openmm.Context(
+                system, integrator, simulation.context.getPlatform()
+            )
+            contexts.append((system, context, integrator))
+        return contexts
+
+    def relax_grid_point(self, system, context, shot, start, crit=1e-4):
+        """
+        OpenMM.optimize(shot, align=False) on the given system and context,
+        starting from the positions start in nanometers. Returns the energy
+        without the restraints, the RMSD from the QM geometry, the relaxed
+        molecule and the relaxed positions.
+        """
+        engine = self.engine
+        context.setPositions(start)
+        context.computeVirtualSites()
+        groups = set(range(32))
+        if engine.restraint_frc_index is not None:
+            force = system.getForce(engine.restraint_frc_index)
+            xyz = engine.ref_mol.xyzs[shot] / 10.0
+            for i, j in enumerate(engine.realAtomIdxs):
+                force.setParticleParameters(i, j, xyz[i])
+            force.updateParametersInContext(context)
+            groups.remove(force.getForceGroup())
+
+        def energy():
+            state = context.getState(getEnergy=True)
+            return state.getPotentialEnergy().value_in_unit(
+                openmm_unit.kilojoule_per_mole
+            )
+
+        # the tolerances are in kJ/mol like those of OpenMM.optimize
+        steps = int(max(1, -1 * np.log10(crit)))
+        for logc in np.linspace(0, np.log10(crit), steps):
+            openmm.LocalEnergyMinimizer.minimize(context, 10**logc, 100000)
+        for _ in range(1000):
+            e_minimized = energy()
+            openmm.LocalEnergyMinimizer.minimize(context, crit, 10)
+            if abs(energy() - e_minimized) < crit * 10:
+                break
+        else:
+            logger.error("Energy minimization did not converge")
+            raise RuntimeError("Energy minimization did not converge")
+        state = context.getState(getPositions=True, getEnergy=True, groups=groups)
+        positions = state.getPositions(asNumpy=True).value_in_unit(
+            openmm_unit.nanometer
+        )
+        energy = state.getPotentialEnergy().value_in_unit(
+            openmm_unit.kilocalorie_per_mole
+        )
+        M = deepcopy(engine.mol[0])
+        M += deepcopy(M)
+        M.xyzs = [engine.mol.xyzs[shot], positions[engine.realAtomIdxs] * 10.0]
+        return energy, M.ref_rmsd(0)[1], M[1], positions
+
+    def relax_chain(self, links, system, context, results):
+        """Relax the grid points of one chain in order, into results."""
+        qm_positions = [
+            np.asarray(
+                self.engine.xyz_omms[shot][0].value_in_unit(openmm_unit.nanometer)
+            )
+            for shot, _ in links
+        ]
+        relaxed = {}
+        for (shot, seed), qm in zip(links, qm_positions):
+            start = qm
+            if seed is not None:
+                seed_qm, seed_relaxed = relaxed[seed]
+                rotation = rotation_matrix(seed_qm, qm)
+                start = qm + (seed_relaxed - seed_qm) @ rotation
+            time_start = time.perf_counter()
+            *result, positions = self.relax_grid_point(system, context, shot, start)
+            self.grid_times[shot] += time.perf_counter() - time_start
+            results[shot] = result
+            relaxed[shot] = (qm, positions)
+
+    def relax_grid(self):
+        """(energy, rmsd, relaxed molecule) of every grid point."""
+        self.engine.update_simulation()
+        results = [None] * self.ns
+        contexts = self.grid_contexts()
+        if len(contexts) == 1:
+            system, context, _ = contexts[0]
+            self.relax_chain(self.grid_chains[0], system, context, results)
+        else:
+            with ThreadPoolExecutor(len(contexts)) as executor:
+                futures = [
+                    executor.submit(self.relax_chain, links, system, context, results)
+                    for links, (system, context, _) in zip(self.grid_chains, contexts)
+                ]
+                for future in futures:
+                    future.result()
+        return results
+
+    def analytic_dV(self, mvals, M_opts, weights):
+        """
+        Rows of the derivatives of the residuals that are known without
+        finite differences, by mathematical parameter.
+        """
+        return {}
+
+    def get(self, mvals, AGrad=False, AHess=False):
+        Answer = {
+            "X": 0.0,
+            "G": np.zeros(self.FF.np),
+            "H": np.zeros((self.FF.np, self.FF.np)),
+        }
+        self.PrintDict = OrderedDict()
+        weights = np.sqrt(self.wts) / self.energy_denom
+        self.grid_times = np.zeros(self.ns)
+
+        def compute(mvals_):
+            self.FF.make(mvals_)
+            results = self.relax_grid()
+            compute.emm = np.array([energy for energy, _, _ in results])
+            compute.emm -= compute.emm[self.smin]
+            compute.rmsd = np.array([rmsd for _, rmsd, _ in results])
+            compute.M_opts = [M_opt for _, _, M_opt in results]
+            return weights * (compute.emm - self.eqm)
+
+        V = compute(mvals)
+        emm, rmsd, M_opts = compute.emm, compute.rmsd, compute.M_opts
+        evaluation_times = self.grid_times.copy()
+        Answer["X"] = np.dot(V, V)
+
+        if self.writelevel > 0:
+            np.savetxt(
+                "EnergyCompare.txt",
+                np.array([self.eqm, emm, emm - self.eqm, weights]).T,
+                header="%11s  %12s  %12s  %12s"
+                % ("QMEnergy", "MMEnergy", "Delta(MM-QM)", "Weight"),
+                fmt="% 12.6e",
+            )
+            M_all = deepcopy(M_opts[0])
+            for M_opt in M_opts[1:]:
+                M_all += M_opt
+            M_all.write("mm_minimized.xyz")
+
+        e_rmse = np.sqrt(np.dot(self.wts, (emm - self.eqm) ** 2))
+        grid_ids = self.metadata["torsion_grid_ids"]
+        self.PrintDict[self.name] = (
+            "%10s %10s    %6.3f - %-6.3f   % 6.3f - %-6.3f    %6.3f    %7.4f   % 7.4f"
+            % (
+                ",".join(["%i" % i for i in grid_ids[self.smin]]),
+                ",".join(["%i" % i for i in grid_ids[np.argmin(emm)]]),
+                min(self.eqm),
+                max(self.eqm),
+                min(emm),
+                max(emm),
+                max(rmsd),
+                e_rmse,
+                Answer["X"],
+            )
+        )
+
+        dV = np.zeros((self.FF.np, len(V)))
+        if AGrad or AHess:
+            analytic = self.analytic_dV(mvals, M_opts, weights)
+            for p in self.pgrad:
+                if p in analytic:
+                    dV[p, :] = analytic[p]
+                else:
+                    dV[p, :], _ = f12d3p(fdwrap(compute, mvals, p), h=self.h, f0=V)
+
+        if not in_fd():
+            with open("GridTimings.txt", "w") as file:
+                file.write(
+                    "# %10s  %12s  %12s  %12s\n"
+                    % ("Grid", "MMEnergy", "Time(s)", "Total(s)")
+                )
+                for shot in range(self.ns):
+                    file.write(
+                        "%12s  % 12.6e  %12.3f  %12.3f\n"
+                        % (
+                            ",".join(["%i" % i for i in grid_ids[shot]]),
+                            emm[shot],
+                            evaluation_times[shot],
+                            self.grid_times[shot],
+                        )
+                    )
+
+        for p in self.pgrad:
+            Answer["G"][p] = 2 * np.dot(V, dV[p, :])
+            for q in self.pgrad:
+                Answer["H"][p, q] = 2 * np.dot(dV[p, :], dV[q, :])
+        if not in_fd():
+            self.objective = Answer["X"]
+            self.FF.make(mvals)
+        return Answer
+
+
+class TorsionProfileKBasis_SMIRNOFF(TorsionProfileGrid_SMIRNOFF):
+    """
+    Torsion profile target whose derivatives with respect to the proper torsion
+    force constants come from a basis of unit-k torsion energies instead of
+    finite differences.
+
+    The proper torsion energy k (1 + cos(n phi - phase)) / idivf is linear in k
+    at a fixed geometry, and the MM energy of a grid point is a minimum over the
+    coordinates that are not frozen, so its derivative with respect to k is the
+    unit-k energy of the terms of k at the relaxed geometry. This is exact with
+    restrain_k 0, with the default positional restraints it leaves out the
+    change of the restraint energy as the relaxed geometry follows k. The basis
+    is built from the relaxed geometries of every evaluation, and only the other
+    parameters are still perturbed.
+    """
+
+    def __init__(self, options, tgt_opts, forcefield):
+        super().__init__(options, tgt_opts, forcefield)
+        self.build_k_basis_terms()
+
+    def build_k_basis_terms(self):
+        """
+        Find the mathematical parameters which only move proper torsion k
+        parameters and the torsion terms of the molecule each of those k
+        parameters applies to.
+        """
+        pids = defaultdict(list)
+        for pid, index in self.FF.map.items():
+            pids[index].append(pid)
+        k_pvals = {}
+        for index, names in pids.items():
+            match = re.fullmatch(r"ProperTorsions/Proper/k(\d+)/(.+)", names[0])
+            if len(names) == 1 and match is not None:
+                k_pvals[index] = (match.group(2), int(match.group(1)) - 1)
+
+        self.k_rows = sorted(k_pvals)
+        tmI = np.asarray(self.FF.tmI)
+        self.k_mvals = set()
+        if not self.FF.logarithmic_map:
+            for p in range(self.FF.np):
+                moved = set(np.flatnonzero(tmI[:, p]))
+                if len(moved) > 0 and moved <= k_pvals.keys():
+                    self.k_mvals.add(p)
+        # d(pvals of the k rows) / d(mvals)
+        self.k_tmI = tmI[self.k_rows, :]
+
+        labels = self.engine.forcefield.label_molecules(self.engine.off_topology)[0]
+        # (atoms, basis row, periodicity, phase, idivf) of every torsion term
+        terms = []
+        rows = {k_pvals[index]: row for row, index in enumerate(self.k_rows)}
+        for atoms, parameter in labels["ProperTorsions"].items():
+            for term in range(len(parameter.k)):
+                if (parameter.smirks, term) not in rows:
+                    continue
+                # an idivf of "auto" is 1.0 for proper torsions
+                idivf = 1.0 if parameter.idivf is None else parameter.idivf[term]
+                terms.append(
+                    (
+                        atoms,
+                        rows[(parameter.smirks, term)],
+                        parameter.periodicity[term],
+                        parameter.phase[term].m_as(unit.radian),
+                        idivf,
+                    )
+                )
+        self.k_torsions = np.array([term[0] for term in terms], dtype=int).reshape(
+            -1, 4
+        )
+        self.k_term_rows = np.array([term[1] for term in terms], dtype=int)
+        self.k_term_periodicities = np.array([term[2] for term in terms], dtype=float)
+        self.k_term_phases = np.array([term[3] for term in terms], dtype=float)
+        self.k_term_idivfs = np.array([term[4] for term in terms], dtype=float)
+
+    def k_basis(self, geometries):
+        """The (n_frames, n_k_rows) unit-k torsion energies of the geometries."""
+        basis = np.zeros((len(geometries), len(self.k_rows)))
+        if len(self.k_torsions) == 0:
+            return basis
+        for i, xyz in enumerate(geometries):
+            phi = dihedral_angles(np.asarray(xyz), self.k_torsions)
+            energies = (
+                1.0 + np.cos(self.k_term_periodicities * phi - self.k_term_phases)
+            ) / self.k_term_idivfs
+            np.add.at(basis[i], self.k_term_rows, energies)
+        return basis
+
+    def analytic_dV(self, mvals, M_opts, weights):
+        k_pgrad = [p for p in self.pgrad if p in self.k_mvals]
+        if len(k_pgrad) == 0:
+            return {}
+        basis = self.k_basis([M_opt.xyzs[0] for M_opt in M_opts])
+        basis -= basis[self.smin]
+        dV = (weights[:, None] * (basis @ self.k_tmI[:, k_pgrad])).T
+        return dict(zip(k_pgrad, dV))
+
+
+class OptGeoWarmStart_SMIRNOFF(OptGeoTarget_SMIRNOFF):
+    """
+    Optimized geometry target whose MM minimizations start from the minimized
+    geometries of the previous evaluation when the warm_start_rmsd target
+    option is set, and from the QM geometries otherwise. The finite difference
+    steps start from the geometries of the evaluation they perturb, so every
+    step of a gradient starts from the same geometry. A minimization which ends
+    more than warm_start_rmsd Angstrom away from where it started has likely
+    left its basin and is done again from the QM geometry.
+    """
+
+    def __init__(self, options, tgt_opts, forcefield):
+        super().__init__(options, tgt_opts, forcefield)
+        self.warm_start_rmsd = tgt_opts.get("warm_start_rmsd")
+        self.warm_start_positions = {}
+        # the geometries of the previous iteration sent with a remote task
+        file_name = os.path.join(self.root, WARM_START_FILE)
+        if self.warm_start_rmsd is not None and os.path.exists(file_name):
+            with np.load(file_name) as positions:
+                self.warm_start_positions = {
+                    sysname: positions[sysname]
+                    for sysname in positions.files
+                    if sysname in self.sys_opts
+                }
+        self.start_counts = defaultdict(int)
+
+    def system_driver(self, sysname, save_mol=None):
+        engine = self.engines[sysname]
+        seed = self.warm_start_positions.get(sysname)
+        qm_positions = engine.xyz_omms[0]
+        if (
+            self.warm_start_rmsd is None
+            or seed is None
+            or len(seed) != len(qm_positions[0])
+        ):
+            self.start_counts["qm"] += 1
+            v_ic = super().system_driver(sysname, save_mol)
+        else:
+            self.start_counts["warm"] += 1
+            engine.xyz_omms[0] = (
+                openmm_unit.Quantity(seed, openmm_unit.angstrom),
+                qm_positions[1],
+            )
+            try:
+                v_ic = super().system_driver(sysname, save_mol)
+            finally:
+                engine.xyz_omms[0] = qm_positions
+            # the minimizer does not move the frame, so no alignment is needed
+            displacement = engine.getContextPosition() - seed
+            if (
+                np.sqrt(np.mean(np.sum(displacement**2, axis=1)))
+                > self.warm_start_rmsd
+            ):
+                self.start_counts["restart"] += 1
+                v_ic = super().system_driver(sysname, save_mol)
+        if not in_fd():
+            self.warm_start_positions[sysname] = engine.getContextPosition()
+        return v_ic
+
+    def get(self, mvals, AGrad=False, AHess=False):
+        self.start_counts.clear()
+        Answer = super().get(mvals, AGrad, AHess)
+        if self.warm_start_rmsd is not None:
+            np.savez(WARM_START_FILE, **self.warm_start_positions)
+            logger.info(
+                "%s: %i of %i minimizations warm-started, %i of them restarted "
+                "from the QM geometry\n"
+                % (
+                    self.name,
+                    self.start_counts["warm"],
+                    self.start_counts["warm"] + self.start_counts["qm"],
+                    self.start_counts["restart"],
+                )
+            )
+        return Answer
+
+
+def send_warm_start_positions(submit_jobs):
+    """
+    Wrap RemoteTarget.submit_jobs to send the minimized geometries returned by
+    the latest task of the target with the next one.
+    """
+
+    @functools.wraps(submit_jobs)
+    def wrapper(self, mvals, AGrad=False, AHess=False):
+        if self.r_tgt_opts.get("warm_start_rmsd") is not None:
+            tempdir = os.path.join(self.root, self.tempdir)
+            iterdirs = sorted(
+                directory
+                for directory in os.listdir(tempdir)
+                if directory.startswith("iter_")
+                and os.path.exists(os.path.join(tempdir, directory, WARM_START_FILE))
+            )
+            # copied, the result of the task is extracted over it
+            if len(iterdirs) > 0 and not os.path.exists(WARM_START_FILE):
+                shutil.copyfile(
+                    os.path.join(tempdir, iterdirs[-1], WARM_START_FILE),
+                    WARM_START_FILE,
+                )
+        return submit_jobs(self, mvals, AGrad, AHess)
+
+    return wrapper
+
+
+def install_warm_start():
+    """Send the minimized geometries of the opt-geo targets to the workers."""
+    forcebalance.target.RemoteTarget.submit_jobs = send_warm_start_positions(
+        forcebalance.target.RemoteTarget.submit_jobs
+    )
+
+
+def read_target_parameters(target_dir, archive=None, name=None):
+    """
+    The SMIRKS applied to each molecule file of a target, from its
+    target-parameters.json, or None if it has not been labelled.
+    """
+    if archive is not None and name in archive:
+        try:
+            return json.loads(archive.read(name, TARGET_PARAMETERS_FILE))["molecules"]
+        except KeyError:
+            return None
+    file_name = os.path.join(target_dir, TARGET_PARAMETERS_FILE)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as file:
+        return json.load(file)["molecules"]
+
+
+def dependent_mvals(forcefield, smirks):
+    """
+    The mathematical parameters of the parameters with the given SMIRKS, plus
+    the global parameters such as the 1-4 scaling factors which every target
+    depends on.
+    """
+    smirks = set(smirks)
+    mvals = set()
+    for pname in forcefield.pTree:
+        # Parent/Tag/param/SMIRKS, the SMIRKS can contain / itself
+        fields = pname.split("/", 3)
+        if pname.startswith("/") or (len(fields) == 4 and fields[3] in smirks):
+            mvals.update(forcefield.get_mathid(pname))
+    return mvals
+
+
+def update_pgrads_from_labels(update_pgrads):
+    """Wrap smirnoff_update_pgrads to use target-parameters.json if present."""
+
+    @functools.wraps(update_pgrads)
+    def wrapper(target):
+        molecules = read_target_parameters(os.path.join(target.root, target.tgtdir))
+        if molecules is None:
+            return update_pgrads(target)
+        mvals = dependent_mvals(target.FF, chain(*molecules.values()))
+        target.pgrad = sorted(mvals.intersection(target.pgrad))
+
+    return wrapper
+
+
+def build_system_mval_masks_from_labels(build_system_mval_masks):
+    """Wrap OptGeoTarget_SMIRNOFF.build_system_mval_masks the same way."""
+
+    @functools.wraps(build_system_mval_masks)
+    def wrapper(self):
+        if hasattr(self, "system_mval_masks"):
+            return
+        molecules = read_target_parameters(os.path.join(self.root, self.tgtdir))
+        if molecules is None or any(
+            file_name not in molecules
+            for sysopt in self.sys_opts.values()
+            for file_name in sysopt["mol2"]
+        ):
+            return build_system_mval_masks(self)
+        system_mval_masks = {}
+        for sysname, sysopt in self.sys_opts.items():
+            mask = np.zeros(self.FF.np, dtype=bool)
+            smirks = chain(*(molecules[file_name] for file_name in sysopt["mol2"]))
+            mask[sorted(dependent_mvals(self.FF, smirks))] = True
+            system_mval_masks[sysname] = mask
+        self.system_mval_masks = system_mval_masks
+
+    return wrapper
+
+
+def install_dependency_map(objective, archive=None):
+    """
+    Differentiate every target of the objective only with respect to the
+    parameters applied to its molecules. The reduced pgrad of a remote target
+    is sent to its worker with the other target options.
+    """
+    incidences = 0
+    for target in objective.Targets:
+        molecules = read_target_parameters(
+            os.path.join(target.root, target.tgtdir), archive, target.name
+        )
+        if molecules is not None:
+            mvals = dependent_mvals(target.FF, chain(*molecules.values()))
+            target.pgrad = sorted(mvals.intersection(target.pgrad))
+        incidences += len(target.pgrad)
+    logger.info(
+        "Parameter dependency map: %i target-parameter pairs to differentiate out "
+        "of %i\n" % (incidences, len(objective.Targets) * objective.FF.np)
+    )
+
+
+def coverage_subsample(tgt_opts, root, coverage, archive=None):
+    """
+    A subsample of the targets in which every parameter applied to the targets
+    of a type is still applied to coverage of them (or all of them if fewer),
+    picked greedily by the most parameters still short of coverage. Targets
+    that have not been labelled are always kept.
+    """
+    kept = []
+    labelled = {}
+    for index, opts in enumerate(tgt_opts):
+        molecules = read_target_parameters(
+            os.path.join(root, "targets", opts["name"]), archive, opts["name"]
+        )
+        if molecules is None:
+            kept.append(index)
+        else:
+            labelled[index] = {
+                (opts["type"], smirks) for smirks in chain(*molecules.values())
+            }
+
+    needed = defaultdict(int)
+    for keys in labelled.values():
+        for key in keys:
+            needed[key] = min(needed[key] + 1, coverage)
+    while len(labelled) > 0:
+        index, keys = max(
+            labelled.items(),
+            key=lambda item: (sum(needed[key] > 0 for key in item[1]), -item[0]),
+        )
+        if not any(needed[key] > 0 for key in keys):
+            break
+        kept.append(index)
+        del labelled[index]
+        for key in keys:
+            needed[key] -= 1
+    return [tgt_opts[index] for index in sorted(kept)]
+
+
+class ChargedForceField:
+    """
+    An OpenFF force field that creates the systems of the molecules with the
+    partial charges stored with them instead of charging them again.
+    """
+
+    def __init__(self, force_field, molecules):
+        self.force_field = force_field
+        self.molecules = molecules
+
+    def __getattr__(self, name):
+        return getattr(self.force_field, name)
+
+    def create_openmm_system(self, topology, **kwargs):
+        kwargs.setdefault("charge_from_molecules", self.molecules)
+        return self.force_field.create_openmm_system(topology, **kwargs)
+
+    def create_interchange(self, topology, **kwargs):
+        kwargs.setdefault("charge_from_molecules", self.molecules)
+        return self.force_field.create_interchange(topology, **kwargs)
+
+
+class ChargedFF:
+    """The FF of an engine, handing out a ChargedForceField while it prepares."""
+
+    def __init__(self, FF, molecules):
+        self.FF = FF
+        self.openff_forcefield = ChargedForceField(FF.openff_forcefield, molecules)
+
+    def __getattr__(self, name):
+        return getattr(self.FF, name)
+
+
+def read_charged_molecules(file_names):
+    """The molecules of the sdf files that create-fb-inputs stored charges in."""
+    molecules = []
+    for file_name in file_names:
+        if not file_name.endswith(".sdf"):
+            continue
+        molecule = forcebalance.smirnoffio.OffMolecule.from_file(file_name)
+        # a file of several records has no stored charges
+        if not isinstance(molecule, list) and molecule.partial_charges is not None:
+            molecules.append(molecule)
+    return molecules
+
+
+def prepare_with_stored_charges(prepare):
+    """
+    Prepare the SMIRNOFF engines with the partial charges stored in their
+    molecule files, so the systems of every update_simulation are created
+    without running AM1BCC-ELF10 again.
+    """
+
+    @functools.wraps(prepare)
+    def wrapper(engine, pbc=False, mmopts={}, **kwargs):
+        molecules = read_charged_molecules(engine.mol2)
+        if len(molecules) == 0 or not hasattr(engine, "FF"):
+            return prepare(engine, pbc, mmopts, **kwargs)
+        FF = engine.FF
+        engine.FF = ChargedFF(FF, molecules)
+        try:
+            return prepare(engine, pbc, mmopts, **kwargs)
+        finally:
+            # engine.forcefield stays the ChargedForceField
+            engine.FF = FF
+
+    return wrapper
+
+
+def install_target_extensions():
+    """Register the target types here and the label-based pgrad updates."""
+    forcebalance.objective.Implemented_Targets[
+        TORSION_GRID_TYPE
+    ] = TorsionProfileGrid_SMIRNOFF
+    forcebalance.objective.Implemented_Targets[
+        TORSION_K_BASIS_TYPE
+    ] = TorsionProfileKBasis_SMIRNOFF
+    for target_type in OPT_GEO_TYPES:
+        forcebalance.objective.Implemented_Targets[
+            target_type
+        ] = OptGeoWarmStart_SMIRNOFF
+    forcebalance.smirnoffio.smirnoff_update_pgrads = update_pgrads_from_labels(
+        forcebalance.smirnoffio.smirnoff_update_pgrads
+    )
+    OptGeoTarget_SMIRNOFF.build_system_mval_masks = build_system_mval_masks_from_labels(
+        OptGeoTarget_SMIRNOFF.build_system_mval_masks
+    )
+    smirnoff = forcebalance.smirnoffio.SMIRNOFF
+    smirnoff.prepare = prepare_with_stored_charges(smirnoff.prepare)
+
+
+def install_worker_extensions():
+    """Set up ForceBalance on a worker to run a remote target."""
+    install_target_extensions()
+    molecule = forcebalance.molecule.Molecule
+    molecule.read_xyz = read_packed_xyz(molecule.read_xyz)
+    molecule.read_qdata = read_packed_qdata(molecule.read_qdata)
@@ -0,0 +1,203 @@
+"""
+Telemetry of the ForceBalance targets of the Sage fit.
+
+Every objective evaluation appends one JSON line per target to a telemetry
+file: the contribution of the target to the objective, its share of the
+gradient norm, the wall time of its evaluation, the worker host it ran on,
+how often its task was submitted and how long the task waited in the queue.
+summarize reads the file back and lists the slowest targets and the targets
+that contribute most to the objective.
+"""
+import functools
+import json
+import time
+from collections import defaultdict
+
+import forcebalance.target
+import numpy as np
+from forcebalance.finite_difference import in_fd
+from forcebalance.optimizer import Counter
+
+
+class Telemetry:
+    """Per-target records of the objective evaluations, written as JSON lines."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.evaluation = 0
+        # target name -> fields of the target in the current evaluation
+        self.targets = defaultdict(dict)
+
+    def task_submitted(self, tag, speculative=False):
+        fields = self.targets[tag]
+        fields["submissions"] = fields.get("submissions", 0) + 1
+        if speculative:
+            fields["speculative"] = fields.get("speculative", 0) + 1
+
+    def task_finished(self, tag, host, wall_time, turnaround, result):
+        fields = self.targets[tag]
+        if result != 0:
+            fields["failures"] = fields.get("failures", 0) + 1
+            return
+        fields["host"] = host
+        fields["wall_time"] = wall_time
+        # everything but the run itself: waiting for a worker and transfers
+        fields["queue_wait"] = max(0.0, turnaround - wall_time)
+
+    def target_evaluated(self, target, answer, seconds):
+        fields = self.targets[target.name]
+        fields["type"] = target.__class__.__name__
+        fields["residual"] = float(answer["X"])
+        fields["weight"] = target.weight
+        fields["gradient"] = np.asarray(answer["G"], dtype=float)
+        fields.setdefault("wall_time", seconds)
+
+    def write(self, objective, order):
+        """Write the records of the evaluation that just finished."""
+        self.evaluation += 1
+        now = time.time()
+        gradients = {}
+        for target in objective.Targets:
+            fields = self.targets.get(target.name, {})
+            if "gradient" in fields:
+                gradients[target.name] = np.linalg.norm(
+                    fields["gradient"] * target.weight / objective.WTot
+                )
+        gradient_total = sum(gradients.values())
+
+        with open(self.file_name, "a") as file:
+            for target in objective.Targets:
+                fields = self.targets.pop(target.name, {})
+                if "residual" not in fields:
+                    continue
+                fields.pop("gradient")
+                submissions = fields.get("submissions", 0)
+                record = {
+                    "time": now,
+                    "evaluation": self.evaluation,
+                    "iteration": Counter(),
+                    "order": order,
+                    "target": target.name,
+                    "type": fields["type"],
+                    "residual": fields["residual"],
+                    "weight": fields["weight"],
+                    "objective": fields["residual"] * fields["weight"] / objective.WTot,
+                    "gradient_norm": gradients[target.name] if order > 0 else None,
+                    "gradient_share": gradients[target.name] / gradient_total
+                    if order > 0 and gradient_total > 0
+                    else None,
+                    "wall_time": fields.get("wall_time"),
+                    "host": fields.get("host"),
+                    "submissions": submissions,
+                    "retries": max(0, submissions - 1 - fields.get("speculative", 0)),
+                    "speculative": fields.get("speculative", 0),
+                    "failures": fields.get("failures", 0),
+                    "queue_wait": fields.get("queue_wait"),
+                }
+                file.write(json.dumps(record) + "\n")
+        self.targets.clear()
+
+    def watch(self, objective):
+        """Write the records after every evaluation of the objective."""
+        full = objective.Full
+
+        @functools.wraps(full)
+        def wrapper(vals, Order=0, verbose=False, customdir=None):
+            answer = full(vals, Order, verbose, customdir)
+            if not in_fd():
+                self.write(objective, Order)
+            return answer
+
+        objective.Full = wrapper
+
+    def install(self):
+        """Record the answer of every target evaluation outside of finite differences."""
+        meta_get = forcebalance.target.Target.meta_get
+
+        @functools.wraps(meta_get)
+        def wrapper(target, mvals, AGrad=False, AHess=False, customdir=None):
+            start = time.time()
+            answer = meta_get(target, mvals, AGrad, AHess, customdir)
+            if not in_fd():
+                self.target_evaluated(target, answer, time.time() - start)
+            return answer
+
+        forcebalance.target.Target.meta_get = wrapper
+
+
+def read_records(file_name):
+    with open(file_name) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize(file_name, n_targets=20):
+    """
+    Lines of a summary of the telemetry file: the targets with the most wall
+    time and the targets with the largest contribution to the objective in
+    the last evaluation they were part of.
+    """
+    by_target = defaultdict(list)
+    for record in read_records(file_name):
+        by_target[record["target"]].append(record)
+
+    rows = []
+    for name, records in by_target.items():
+        wall_times = [r["wall_time"] for r in records if r["wall_time"] is not None]
+        waits = [r["queue_wait"] for r in records if r["queue_wait"] is not None]
+        shares = [
+            r["gradient_share"] for r in records if r["gradient_share"] is not None
+        ]
+        rows.append(
+            {
+                "target": name,
+                "evaluations": len(records),
+                "total_time": sum(wall_times),
+                "mean_time": np.mean(wall_times) if wall_times else 0.0,
+                "mean_wait": np.mean(waits) if waits else 0.0,
+                "retries": sum(r["retries"] for r in records),
+                "objective": records[-1]["objective"],
+                "gradient_share": np.mean(shares) if shares else 0.0,
+                "hosts": len({r["host"] for r in records if r["host"] is not None}),
+            }
+        )
+
+    header = "%-40s %6s %12s %10s %10s %7s %14s %9s" % (
+        "Target",
+        "Evals",
+        "Total(s)",
+        "Mean(s)",
+        "Wait(s)",
+        "Retries",
+        "Objective",
+        "GradShare",
+    )
+
+    def table(title, key):
+        lines = [title, header]
+        for row in sorted(rows, key=lambda row: row[key], reverse=True)[:n_targets]:
+            lines.append(
+                "%-40s %6i %12.1f %10.1f %10.1f %7i % 14.5e %9.4f"
+                % (
+                    row["target"],
+                    row["evaluations"],
+                    row["total_time"],
+                    row["mean_time"],
+                    row["mean_wait"],
+                    row["retries"],
+                    row["objective"],
+                    row["gradient_share"],
+                )
+            )
+        return lines
+
+    total_time = sum(row["total_time"] for row in rows)
+    total_objective = sum(row["objective"] for row in rows)
+    lines = [
+        "%i targets, %.1f hours of target wall time, last objective %.5e"
+        % (len(rows), total_time / 3600, total_objective),
+        "",
+    ]
+    lines += table("Slowest targets", "total_time")
+    lines += [""]
+    lines += table("Largest objective contributions", "objective")
+    return lines
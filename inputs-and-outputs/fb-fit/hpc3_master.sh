@@ -25,10 +25,11 @@ source fb_193/bin/activate
 echo $(python -V)
 
 rsync  -avzIi  $SLURM_SUBMIT_DIR/optimize.in  $SLURM_TMPDIR/$SLURM_JOB_NAME
-rsync  -avzIi  $SLURM_SUBMIT_DIR/targets.tar.gz  $SLURM_TMPDIR/$SLURM_JOB_NAME
+rsync  -avzIi  $SLURM_SUBMIT_DIR/targets.zip  $SLURM_TMPDIR/$SLURM_JOB_NAME
 rsync  -avzIi  $SLURM_SUBMIT_DIR/forcefield  $SLURM_TMPDIR/$SLURM_JOB_NAME
+rsync  -avzIi  $SLURM_SUBMIT_DIR/run_forcebalance.py $SLURM_SUBMIT_DIR/fb_queue.py $SLURM_SUBMIT_DIR/fb_targets.py $SLURM_SUBMIT_DIR/fb_telemetry.py $SLURM_SUBMIT_DIR/remote_target.py  $SLURM_TMPDIR/$SLURM_JOB_NAME
 
-tar -xzf targets.tar.gz
+# the targets are read from the indexed archive, see run_forcebalance.py pack-targets
 
 datadir=$(pwd)
 mkdir -p $SLURM_SUBMIT_DIR/worker_logs
@@ -37,7 +38,12 @@ echo $(hostname) > $SLURM_SUBMIT_DIR/host
 export OMP_NUM_THREADS=1
 export MKL_NUM_THREADS=1
 
-if ForceBalance.py optimize.in ; then
+# target timings are kept in the submit directory so the longest-processing-time
+# first ordering carries over between runs, and so is the telemetry of the run.
+# The optimizer state is checkpointed there after every iteration, a job started
+# again after the allocation or the node is lost resumes from the last one. A
+# finished fit renames it to optimize.chk.finished
+if python run_forcebalance.py optimize -in optimize.in -tt $SLURM_SUBMIT_DIR/target-timings.json -ta targets.zip -tm $SLURM_SUBMIT_DIR/telemetry.jsonl -ck $SLURM_SUBMIT_DIR/optimize.chk --restart ; then
    tar -czf optimize.tmp.tar.gz optimize.tmp
    tar -czf result.tar.gz result
    mkdir -p ~/fit9/$SLURM_JOB_ID
@@ -46,7 +52,7 @@ if ForceBalance.py optimize.in ; then
    find ./ -type f -exec chgrp dmobley_lab_share {} \;
    find ./ -type d -exec chmod g+s {} \;
    find ./ -type f -exec chmod g+s {} \;
-   rsync  -avzIi --no-o --no-g --recursive --exclude="optimize.tmp" --exclude="optimize.bak" --exclude="fb_193*" --exclude="targets*" $SLURM_TMPDIR/$SLURM_JOB_NAME/* $SLURM_SUBMIT_DIR --rsync-path="sudo rsync" > copy.log
+   rsync  -avzIi --no-o --no-g --recursive --exclude="optimize.tmp" --exclude="optimize.bak" --exclude="fb_193*" --exclude="targets*" --exclude="input-cache" $SLURM_TMPDIR/$SLURM_JOB_NAME/* $SLURM_SUBMIT_DIR --rsync-path="sudo rsync" > copy.log
    #rm -rf $SLURM_TMPDIR/$SLURM_JOB_NAME
 fi
 sleep 3h 
@@ -28,11 +28,9 @@ then
 fi
 
 mkdir /tmp/dir -p
-for i in \$(seq  \$SLURM_NTASKS ); do
-        echo $i
-        ./wq_worker_local.sh --cores 1 -s /tmp/dir --disk-threshold=0.002 --disk=3000 --memory-threshold=1000 -t 3600  -b 20 --memory=1000 $host:$port &
-done
-wait
+# one worker for all the cores of the node, the target tasks ask for one core each
+# and share the inputs the worker caches across tasks and iterations
+./wq_worker_local.sh --cores \$SLURM_NTASKS -s /tmp/dir --disk-threshold=0.002 --disk=\$((3000 * SLURM_NTASKS)) --memory-threshold=1000 -t 3600  -b 20 --memory=\$((1000 * SLURM_NTASKS)) $host:$port
 EOF
 
 sbatch $@ $cmd 
@@ -0,0 +1,10 @@
+"""
+Runs a remote ForceBalance target on a worker the way rtarget.py does, with the
+worker side extensions of fb_targets.py installed first.
+"""
+import runpy
+
+import fb_targets
+
+fb_targets.install_worker_extensions()
+runpy.run_path("rtarget.py", run_name="__main__")
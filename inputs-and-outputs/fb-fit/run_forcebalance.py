@@ -0,0 +1,523 @@
+"""
+Runs the ForceBalance optimization of optimize.in the way ``ForceBalance.py
+optimize.in`` does, with the remote targets submitted longest-processing-time
+first from a timing database kept across iterations and runs, and speculative
+duplicates of the slowest tasks sent to idle workers. The target inputs which do
+not change between iterations are cached by the workers. The remote targets are
+evaluated either by a Work Queue worker fleet or by a local process pool, and
+the targets can be read from an indexed zip archive instead of the extracted
+targets directory. Torsion profile targets can relax their grid points from
+their relaxed neighbours on a thread pool and take their torsion force
+constant derivatives from a precomputed basis, and the minimizations of the
+optimized geometry targets can start from the previous minimized geometries,
+see fb_targets.py. The optimization can be staged, running first on
+subsamples of the targets that still cover every parameter. Every objective
+evaluation appends per-target telemetry to telemetry.jsonl, see
+fb_telemetry.py. The optimizer state is checkpointed after every iteration
+and a run can be restarted from the last checkpoint.
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+import pickle
+
+import click
+import numpy as np
+from forcebalance.forcefield import FF
+from forcebalance.objective import Objective
+from forcebalance.optimizer import Optimizer
+from forcebalance.output import getLogger
+from forcebalance.parser import parse_inputs
+
+import fb_queue
+import fb_targets
+import fb_telemetry
+
+logger = getLogger(__name__)
+
+# the stage of a staged optimization that is running and the report of the
+# stages before it, written to the checkpoints with the optimizer state
+CHECKPOINT_STAGE = {"stage": None, "report": []}
+
+# the fit a checkpoint belongs to, see fit_identity
+CHECKPOINT_FIT = {}
+
+# options of this driver that can be set in the $options section of optimize.in,
+# ForceBalance rejects keywords it does not know so they are taken out before
+# the file is parsed
+DRIVER_OPTIONS = {
+    "wq_executor": str,
+    "wq_local_workers": int,
+    "torsion_k_basis": lambda word: word.lower() in ("1", "yes", "true", "on"),
+    "warm_start_rmsd": float,
+    "grid_seeding": lambda word: word.lower() in ("1", "yes", "true", "on"),
+    "grid_threads": int,
+}
+
+
+def parse_driver_inputs(input_file):
+    """
+    Parse optimize.in with ForceBalance after taking out the options meant for
+    this driver, and return them together with the ForceBalance options.
+    """
+    driver_options = {}
+    lines = []
+    in_options = False
+    with open(input_file) as file:
+        for line in file:
+            words = line.split()
+            keyword = words[0].lower() if len(words) > 0 else ""
+            if keyword in ("$options", "$end"):
+                in_options = keyword == "$options"
+            elif in_options and keyword in DRIVER_OPTIONS and len(words) > 1:
+                driver_options[keyword] = DRIVER_OPTIONS[keyword](words[1])
+                continue
+            lines.append(line)
+
+    directory, file_name = os.path.split(os.path.abspath(input_file))
+    forcebalance_input = os.path.join(directory, f".{file_name}")
+    with open(forcebalance_input, "w") as file:
+        file.writelines(lines)
+    try:
+        options, tgt_opts = parse_inputs(forcebalance_input)
+    finally:
+        os.remove(forcebalance_input)
+    # the temporary and result directories are named after the input file
+    options["input_file"] = input_file
+    return driver_options, options, tgt_opts
+
+
+def write_checkpoint(writechk):
+    """
+    Wrap Optimizer.writechk to also write the iteration number, the objective
+    of every target and the stage, and to replace the checkpoint only once it
+    is complete, so a job killed while writing it leaves the last one intact.
+    """
+
+    @functools.wraps(writechk)
+    def wrapper(self):
+        if self.wchk_fnm is None or len(self.chk) == 0:
+            return
+        logger.info("Writing the checkpoint file %s\n" % self.wchk_fnm)
+        checkpoint = dict(
+            self.chk,
+            iteration=self.iteration,
+            objective=dict(self.Objective.ObjDict),
+            **CHECKPOINT_STAGE,
+            **CHECKPOINT_FIT,
+        )
+        file_name = os.path.join(self.root, self.wchk_fnm)
+        with open(file_name + ".tmp", "wb") as file:
+            pickle.dump(checkpoint, file)
+        os.replace(file_name + ".tmp", file_name)
+
+    return wrapper
+
+
+def fit_identity(options, forcefield):
+    """
+    A hash of optimize.in and the force field files and the number of
+    parameters, which a checkpoint has to match to be resumed.
+    """
+    digest = hashlib.sha256()
+    ff_files = [
+        os.path.join(options["root"], options["ffdir"], file_name)
+        for file_name in options["forcefield"]
+    ]
+    for file_name in [options["input_file"], *ff_files]:
+        with open(file_name, "rb") as file:
+            digest.update(file.read())
+    return {"fit_hash": digest.hexdigest(), "n_parameters": forcefield.np}
+
+
+def resume_optimizer(optimizer, checkpoint):
+    """
+    Continue the optimizer from the parameters of a checkpoint, with its trust
+    radius, counting the iterations from the one it was written after. The
+    objective at those parameters was not evaluated before the checkpoint, the
+    first iteration evaluates it.
+    """
+    optimizer.mvals0 = np.array(checkpoint["xk"])
+    optimizer.iterinit = checkpoint["iteration"]
+    if checkpoint["trust"] > 0:
+        # a negative trust0 selects the Hessian diagonal search
+        optimizer.trust0 = math.copysign(checkpoint["trust"], optimizer.trust0)
+    optimizer.Objective.ObjDict_Last = checkpoint["objective"]
+    logger.info(
+        "Resuming from the checkpoint written after iteration %i\n"
+        % (checkpoint["iteration"] - 1)
+    )
+
+
+def build_objective(options, tgt_opts, forcefield, archive, timings, telemetry):
+    objective = Objective(options, tgt_opts, forcefield)
+    fb_targets.install_dependency_map(objective, archive)
+    fb_queue.order_targets(objective, timings)
+    telemetry.watch(objective)
+    return objective
+
+
+def run_stages(
+    options,
+    tgt_opts,
+    forcefield,
+    archive,
+    timings,
+    telemetry,
+    objective,
+    coverages,
+    stage_step,
+    checkpoint=None,
+):
+    """
+    Optimize on subsamples of the targets which keep every parameter applied to
+    the given number of targets, from the smallest coverage up, and promote the
+    parameters of each stage to the next once its steps are shorter than
+    stage_step. Returns the parameters to start the optimization on all the
+    targets from, and a report of the objective on all the targets at every
+    promotion. The stages finished before a checkpoint are skipped.
+    """
+    stage_options = dict(
+        options,
+        convergence_step=stage_step,
+        convergence_objective=0.0,
+        convergence_gradient=0.0,
+        criteria=1,
+    )
+    mvals = options["read_mvals"]
+    report = []
+    if checkpoint is not None:
+        report = checkpoint["report"]
+        if len(report) > 0:
+            mvals = report[-1]["mvals"]
+    CHECKPOINT_STAGE["report"] = report
+    for stage, coverage in enumerate(coverages):
+        # the stages with a report were promoted, and with a checkpoint out of
+        # the optimization on all the targets every stage was
+        if stage < len(report) or (
+            checkpoint is not None and checkpoint["stage"] is None
+        ):
+            continue
+        CHECKPOINT_STAGE["stage"] = stage
+        stage_tgt_opts = fb_targets.coverage_subsample(
+            tgt_opts, options["root"], coverage, archive
+        )
+        if len(stage_tgt_opts) == len(tgt_opts):
+            break
+        logger.info(
+            "Stage with %i targets per parameter: %i of %i targets\n"
+            % (coverage, len(stage_tgt_opts), len(tgt_opts))
+        )
+        stage_options["read_mvals"] = mvals
+        stage_objective = build_objective(
+            stage_options, stage_tgt_opts, forcefield, archive, timings, telemetry
+        )
+        optimizer = Optimizer(stage_options, stage_objective, forcefield)
+        if checkpoint is not None and checkpoint["stage"] == stage:
+            # the stage was interrupted before its promotion
+            resume_optimizer(optimizer, checkpoint)
+        mvals = list(optimizer.Run())
+        # the objective only, without derivatives, on all the targets
+        full_objective = objective.Full(np.array(mvals), 0, verbose=True)["X"]
+        report.append(
+            {
+                "coverage": coverage,
+                "targets": len(stage_tgt_opts),
+                "iterations": optimizer.iteration,
+                "objective": float(optimizer.chk["X"])
+                if "X" in optimizer.chk
+                else None,
+                "full_objective": float(full_objective),
+                "mvals": mvals,
+            }
+        )
+        logger.info(
+            "Promoted the parameters of the stage with %i targets per parameter, "
+            "objective on all targets % .5e\n" % (coverage, full_objective)
+        )
+        # a job killed before the next stage writes a checkpoint starts it again
+        # instead of running this stage once more
+        optimizer.writechk()
+    CHECKPOINT_STAGE["stage"] = None
+    return mvals, report
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "-in",
+    "--input_file",
+    "input_file",
+    type=click.STRING,
+    default="optimize.in",
+)
+@click.option(
+    "-tt",
+    "--target_timings",
+    "target_timings",
+    type=click.STRING,
+    default="target-timings.json",
+)
+@click.option(
+    "-sa",
+    "--speculate_after",
+    "speculate_after",
+    type=click.FLOAT,
+    default=300.0,
+)
+@click.option(
+    "-ex",
+    "--executor",
+    "executor",
+    type=click.Choice(["workqueue", "local"]),
+    default=None,
+)
+@click.option(
+    "-nw",
+    "--workers",
+    "workers",
+    type=click.INT,
+    default=None,
+)
+@click.option(
+    "-cd",
+    "--cache_dir",
+    "cache_dir",
+    type=click.STRING,
+    default="input-cache",
+)
+@click.option(
+    "-ta",
+    "--targets_archive",
+    "targets_archive",
+    type=click.STRING,
+    default=None,
+)
+@click.option(
+    "-kb",
+    "--torsion_k_basis",
+    "torsion_k_basis",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "-ws",
+    "--warm_start_rmsd",
+    "warm_start_rmsd",
+    type=click.FLOAT,
+    default=None,
+)
+@click.option(
+    "-gs",
+    "--grid_seeding",
+    "grid_seeding",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "-gt",
+    "--grid_threads",
+    "grid_threads",
+    type=click.INT,
+    default=None,
+)
+@click.option(
+    "-sc",
+    "--stage_coverage",
+    "stage_coverages",
+    type=click.INT,
+    multiple=True,
+)
+@click.option(
+    "-ss",
+    "--stage_step",
+    "stage_step",
+    type=click.FLOAT,
+    default=0.1,
+)
+@click.option(
+    "-sr",
+    "--stage_report",
+    "stage_report",
+    type=click.STRING,
+    default="stage-report.json",
+)
+@click.option(
+    "-tm",
+    "--telemetry",
+    "telemetry_file",
+    type=click.STRING,
+    default="telemetry.jsonl",
+)
+@click.option(
+    "-ck",
+    "--checkpoint",
+    "checkpoint_file",
+    type=click.STRING,
+    default="optimize.chk",
+)
+@click.option(
+    "-rs",
+    "--restart",
+    "restart",
+    is_flag=True,
+    default=False,
+)
+def optimize(
+    input_file,
+    target_timings,
+    speculate_after,
+    executor,
+    workers,
+    cache_dir,
+    targets_archive,
+    torsion_k_basis,
+    warm_start_rmsd,
+    grid_seeding,
+    grid_threads,
+    stage_coverages,
+    stage_step,
+    stage_report,
+    telemetry_file,
+    checkpoint_file,
+    restart,
+):
+    driver_options, options, tgt_opts = parse_driver_inputs(input_file)
+    # the command line takes precedence over wq_executor and wq_local_workers
+    executor = executor or driver_options.get("wq_executor", "workqueue")
+    workers = workers or driver_options.get("wq_local_workers", os.cpu_count())
+    if executor == "local":
+        fb_queue.install_local_executor(workers)
+    fb_targets.install_target_extensions()
+    torsion_k_basis = torsion_k_basis or driver_options.get("torsion_k_basis", False)
+    grid_seeding = grid_seeding or driver_options.get("grid_seeding", False)
+    grid_threads = grid_threads or driver_options.get("grid_threads", 1)
+    for opts in tgt_opts:
+        if opts["type"] != "TORSIONPROFILE_SMIRNOFF":
+            continue
+        if torsion_k_basis:
+            opts["type"] = fb_targets.TORSION_K_BASIS_TYPE
+        elif grid_seeding or grid_threads > 1:
+            opts["type"] = fb_targets.TORSION_GRID_TYPE
+        # sent to the workers with the other target options
+        opts["grid_seeding"] = grid_seeding
+        opts["grid_threads"] = grid_threads
+    if warm_start_rmsd is None:
+        warm_start_rmsd = driver_options.get("warm_start_rmsd")
+    if warm_start_rmsd is not None:
+        # sent to the workers with the other target options
+        for opts in tgt_opts:
+            if opts["type"] in fb_targets.OPT_GEO_TYPES:
+                opts["warm_start_rmsd"] = warm_start_rmsd
+        fb_targets.install_warm_start()
+    archive = None
+    if targets_archive is not None:
+        archive = fb_targets.TargetArchive(targets_archive)
+        fb_targets.install_target_archive(archive, options["root"], tgt_opts)
+
+    # a checkpoint after every iteration, see write_checkpoint
+    options["writechk"] = checkpoint_file
+    options["writechk_step"] = True
+    Optimizer.writechk = write_checkpoint(Optimizer.writechk)
+    checkpoint = None
+    checkpoint_path = os.path.join(options["root"], checkpoint_file)
+    if restart and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "rb") as file:
+            checkpoint = pickle.load(file)
+        if checkpoint["stage"] is not None and len(stage_coverages) == 0:
+            raise click.UsageError(
+                "The checkpoint was written in a stage of a staged optimization, "
+                "restart with the same --stage_coverage options"
+            )
+
+    timings = fb_queue.TargetTimings(target_timings)
+    telemetry = fb_telemetry.Telemetry(telemetry_file)
+    telemetry.install()
+    forcefield = FF(options)
+    CHECKPOINT_FIT.update(fit_identity(options, forcefield))
+    if checkpoint is not None and any(
+        checkpoint.get(key) != value for key, value in CHECKPOINT_FIT.items()
+    ):
+        raise click.UsageError(
+            f"The checkpoint {checkpoint_path} was written for another optimize.in "
+            "or force field, remove it to start the fit from the beginning"
+        )
+    # creates the Work Queue, which the scheduler then wraps
+    objective = build_objective(
+        options, tgt_opts, forcefield, archive, timings, telemetry
+    )
+    fb_queue.install_scheduler(timings, speculate_after, cache_dir, telemetry)
+
+    if len(stage_coverages) > 0:
+        mvals, report = run_stages(
+            options,
+            tgt_opts,
+            forcefield,
+            archive,
+            timings,
+            telemetry,
+            objective,
+            sorted(stage_coverages),
+            stage_step,
+            checkpoint,
+        )
+        with open(stage_report, "w") as file:
+            json.dump(report, file, indent=2)
+        options["read_mvals"] = mvals
+
+    optimizer = Optimizer(options, objective, forcefield)
+    if checkpoint is not None and checkpoint["stage"] is None:
+        resume_optimizer(optimizer, checkpoint)
+    optimizer.Run()
+    if os.path.exists(checkpoint_path):
+        # a finished fit is not resumed by the next run
+        os.replace(checkpoint_path, checkpoint_path + ".finished")
+
+
+@cli.command("pack-targets")
+@click.option(
+    "-t",
+    "--targets_dir",
+    "targets_dir",
+    type=click.STRING,
+    default="targets",
+)
+@click.option(
+    "-o",
+    "--output",
+    "output",
+    type=click.STRING,
+    default="targets.zip",
+)
+def pack_targets(targets_dir, output):
+    fb_targets.pack_targets(targets_dir, output)
+
+
+@cli.command("summarize-telemetry")
+@click.option(
+    "-tm",
+    "--telemetry",
+    "telemetry_file",
+    type=click.STRING,
+    default="telemetry.jsonl",
+)
+@click.option(
+    "-n",
+    "--n_targets",
+    "n_targets",
+    type=click.INT,
+    default=20,
+)
+def summarize_telemetry(telemetry_file, n_targets):
+    for line in fb_telemetry.summarize(telemetry_file, n_targets):
+        click.echo(line)
+
+
+if __name__ == "__main__":
+    cli()